@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+'''Benchmarks of futme against the offline market simulator
+
+python -m benchmarks.run                          # all scenarios, results printed as json
+python -m benchmarks.run search_min_price --out bench.json
+python -m benchmarks.run autotrader --seconds 30 --latency 0.05
+'''
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fut
+
+import futme.core as core
+import futme.datafile as datafile
+import futme.governor as governor
+import futme.market as market
+import futme.price as price
+import benchmarks.sim as sim
+from futme.autotrader import AutoTrader
+
+logger = logging.getLogger(__name__)
+
+SEED = 19
+
+def setup(players=200, latency=0, club_players=0, credits=10000000, rate_limit=None, gov=None):
+    m = sim.SimMarket(seed=SEED)
+    m.add_random_players(players)
+    price.futbin_client = sim.SimFutbin(m)
+    # each scenario starts without observations from the previous one
+    market.observations = market.MarketObservations()
+    session = sim.SimCore(m, credits=credits, latency=(latency * 0.5, latency * 1.5),
+                          club_players=club_players, rate_limit=rate_limit)
+    # no budgets unless the scenario is about them: the other scenarios measure futme itself
+    gov = gov if gov is not None else governor.Governor(budgets={}, cooldown=0)
+    return m, session, core.Futme(session=session, lookups=sim.SimLookups(m), governor=gov)
+
+def bench_search_min_price(args):
+    m, session, fme = setup(players=args.players, latency=args.latency)
+    searches, walls, exact, errors = [], [], 0, []
+    for rid in sorted(m.defs):
+        true_min = min([x['buyNowPrice'] for x in m.listings(rid)] or [m.defs[rid]['marketDataMaxPrice']])
+        before = session.calls['search']
+        t = time.time()
+        _, mp, _ = fme.tm.search_min_price(m.defs[rid])
+        walls.append(time.time() - t)
+        searches.append(session.calls['search'] - before)
+        exact += (mp == true_min)
+        errors.append(abs(mp - true_min) / float(true_min))
+    return {
+        'cards': len(searches),
+        'searches_per_price': statistics.mean(searches),
+        'searches_max': max(searches),
+        'wall_ms_per_price': statistics.mean(walls) * 1000,
+        'exact_pct': exact * 100.0 / len(searches),
+        'mean_abs_error_pct': statistics.mean(errors) * 100,
+        'search_stats': dict(fme.tm.search_stats)
+    }
+
+def autotrader_setup(args, n, **kwargs):
+    m, session, fme = setup(players=n, latency=args.latency, **kwargs)
+    rids = sorted(m.defs)
+    conf = {
+        'buy': {
+            'default': {'bid': 0, 'interval': 5, 'discount': 0.9, 'flexbid': True, 'quantity': 1},
+            'targets': [{'rid': rid} for rid in rids[:n // 2]]
+        },
+        'flip': {
+            'default': {'bid': 0, 'interval': 5, 'discount': 0.9, 'flexbid': True, 'maxflips': 2, 'sellfor': 0},
+            'targets': [{'rid': rid} for rid in rids[n // 2:]]
+        }
+    }
+    conf_file = 'bench_autotrader_{}.json'.format(n)
+    datafile.save_json(conf, conf_file)
+    return session, fme, AutoTrader(fme, conf_file)
+
+def trader_stats(at, session, calls_before, elapsed):
+    stats = [t.worker.stats for t in at.traders]
+    return {
+        'task_runs': sum(x.runs for x in stats),
+        'task_ms_mean': statistics.mean(x.mean_time() for x in stats) * 1000,
+        'task_lag_ms_mean': statistics.mean(x.mean_lag() for x in stats) * 1000,
+        'task_lag_ms_max': max(x.max_lag for x in stats) * 1000,
+        'requests_per_min': (sum(session.calls.values()) - calls_before) * 60.0 / elapsed,
+        'calls': dict(session.calls)
+    }
+
+def bench_autotrader(args):
+    result = {}
+    for n in args.traders:
+        session, fme, at = autotrader_setup(args, n)
+        calls_before = sum(session.calls.values())
+        loops = []
+        start = time.time()
+        while time.time() - start < args.seconds:
+            t = time.time()
+            at.run()
+            loops.append(time.time() - t)
+            time.sleep(0.01)
+        elapsed = time.time() - start
+        loops.sort()
+        result[str(n)] = trader_stats(at, session, calls_before, elapsed)
+        result[str(n)].update({
+            'loops': len(loops),
+            'loop_ms_mean': statistics.mean(loops) * 1000,
+            'loop_ms_p95': loops[int(len(loops) * 0.95)] * 1000,
+            'loop_ms_max': loops[-1] * 1000
+        })
+    return result
+
+def bench_autotrader_async(args):
+    # only this scenario needs the async runtime
+    import asyncio
+    import futme.aio as aio
+    result = {}
+    for n in args.traders:
+        session, fme, at = autotrader_setup(args, n)
+        calls_before = sum(session.calls.values())
+        start = time.time()
+        try:
+            asyncio.run(asyncio.wait_for(aio.run_autotraders([at], fme, args.concurrency), args.seconds))
+        except asyncio.TimeoutError:
+            pass
+        result[str(n)] = trader_stats(at, session, calls_before, time.time() - start)
+    return result
+
+def bench_governor(args):
+    '''The first --traders autotraders against a FUT that refuses more than 60 calls in 10s'''
+    rate_limit = (60, 10)
+    # the default budgets scaled up to just under the rate limit
+    scale = 300.0 / governor.BUDGETS['total'][0]
+    budgets = {k: (per_minute * scale, burst * 2) for k, (per_minute, burst) in governor.BUDGETS.items()}
+    result = {}
+    for name, gov in [('ungoverned', None), ('governed', governor.Governor(budgets, cooldown=10))]:
+        session, fme, at = autotrader_setup(args, args.traders[0], rate_limit=rate_limit, gov=gov)
+        errors = 0
+        calls_before, refused_before = sum(session.calls.values()), session.throttled
+        start = time.time()
+        while time.time() - start < args.seconds:
+            try:
+                at.run()
+            except fut.exceptions.FutError:
+                errors += 1
+            time.sleep(0.01)
+        elapsed = time.time() - start
+        calls = sum(session.calls.values()) - calls_before
+        refused = session.throttled - refused_before
+        result[name] = {
+            'refused_calls': refused,
+            'task_errors': errors,
+            'ok_requests_per_min': (calls - refused) * 60.0 / elapsed,
+            'governor': {k: dict(v) for k, v in fme.governor.stats.items()}
+        }
+    return result
+
+def bench_unassigned(args):
+    m, session, fme = setup(players=args.players, latency=args.latency)
+    rids = sorted(m.defs)
+    for i in range(50):
+        item = m.make_item(rids[i % len(rids)], rating=50 + i % 15, pile=6)
+        session._unassigned[item['id']] = item
+    session.calls.clear()
+    t = time.time()
+    fme.proc.unassigned()
+    return {'items': 50, 'wall_ms': (time.time() - t) * 1000, 'calls': dict(session.calls)}
+
+def bench_club_all_pages(args):
+    m, session, fme = setup(players=args.players, latency=args.latency, club_players=3000)
+    session.calls.clear()
+    t = time.time()
+    players = fme.club.club_all_pages()
+    return {'players': len(players), 'wall_ms': (time.time() - t) * 1000, 'calls': dict(session.calls)}
+
+def bench_display(args):
+    m, session, fme = setup(players=args.players, club_players=5000)
+    cards = fme.club.club_all_pages()
+    t = time.time()
+    sfmt = fme.disp.format(cards)
+    rows = [fme.disp.sprint(sfmt, c) for c in cards]
+    format_ms = (time.time() - t) * 1000
+    # the same with the name and lookup strings already memoized, rendered in one pass
+    t = time.time()
+    fme.disp.format(cards).table(cards)
+    table_ms = (time.time() - t) * 1000
+    t = time.time()
+    datafile.dump_players(cards, 'bench_dump', fme)
+    return {'cards': len(rows), 'format_ms': format_ms, 'table_ms': table_ms,
+            'dump_players_ms': (time.time() - t) * 1000}
+
+SCENARIOS = {
+    'search_min_price': bench_search_min_price,
+    'autotrader': bench_autotrader,
+    'autotrader_async': bench_autotrader_async,
+    'governor': bench_governor,
+    'unassigned': bench_unassigned,
+    'club_all_pages': bench_club_all_pages,
+    'display': bench_display
+}
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('ascii').strip()
+    except Exception:
+        return None
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        datefmt='%m-%d %H:%M:%S',
+        level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description='futme benchmarks (offline, against benchmarks.sim)')
+    parser.add_argument('scenarios', nargs='*', help='one or more of: ' + ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('--players', type=int, default=200, help='number of players on the market')
+    parser.add_argument('--traders', type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument('--seconds', type=float, default=10, help='how long to run the autotraders')
+    parser.add_argument('--concurrency', type=int, default=4, help='FUT calls in flight for autotrader_async')
+    parser.add_argument('--latency', type=float, default=0, help='mean seconds added to each FUT call')
+    parser.add_argument('--out', help='write results to this file instead of stdout')
+    args = parser.parse_args()
+    unknown = [x for x in args.scenarios if x not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(unknown)))
+
+    # keep the conf and dump files out of ~/.futme
+    datafile.DB_DIR = tempfile.mkdtemp(prefix='futme_bench_')
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'time': int(time.time()),
+            'args': vars(args)
+        }
+    }
+    for name in args.scenarios or sorted(SCENARIOS):
+        t = time.time()
+        results[name] = SCENARIOS[name](args)
+        logger.warning('%s done in %.1fs', name, time.time() - t)
+
+    out = json.dumps(results, indent=4, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import threading
+import time
+from collections import Counter, deque
+from urllib.parse import parse_qs, urlparse
+
+import fut
+
+from futme import datafile, price
+from futme.lookup import Lookups
+
+logger = logging.getLogger(__name__)
+
+# pack id -> (coins, number of items)
+PACKS = {100: (400, 12), 101: (750, 12), 200: (2500, 12), 201: (3750, 12), 300: (7500, 12), 301: (10000, 12)}
+
+class SimMarket(object):
+    '''Order book of a simulated transfer market
+
+    Each player has a true price. Other users keep listing it at or above that price
+    (Poisson arrivals, listings last an hour), and our own listings sell once they are
+    at or below the true price.
+
+    market = SimMarket(seed=1)
+    market.add_player(212198, 12000)
+    market.add_random_players(200)
+    '''
+
+    def __init__(self, seed=None, listing_rate=1/60.0, snipe_rate=0.1):
+        self.random = random.Random(seed)
+        # new listings per second per player, and the chance someone beats us to a bid
+        self.listing_rate = listing_rate
+        self.snipe_rate = snipe_rate
+        self.defs = {}
+        self.true_prices = {}
+        self._books = {}
+        self._refreshed = {}
+        self._lock = threading.RLock()
+        self._next_id = 100000000
+
+    def next_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def add_player(self, rid, true_price, listings=20, **props):
+        '''Add a player definition with its true price and an initial order book'''
+        d = {
+            'assetId': rid, 'resourceId': rid, 'itemType': 'player', 'cardType': 0,
+            'rating': self.random.randint(75, 90), 'rareflag': self.random.choice([0, 1, 1, 3]),
+            'position': self.random.choice(['GK', 'CB', 'LB', 'RB', 'CDM', 'CM', 'CAM', 'LW', 'RW', 'ST']),
+            'teamid': self.random.randint(1, 700), 'leagueId': self.random.randint(1, 60),
+            'nation': self.random.randint(1, 200), 'discardValue': 0,
+            'marketDataMinPrice': price.pround(true_price * 0.3), 'marketDataMaxPrice': price.pround(true_price * 3)
+        }
+        d['discardValue'] = d['rating'] * 8
+        d.update(props)
+        with self._lock:
+            self.defs[rid] = d
+            self.true_prices[rid] = true_price
+            self._books[rid] = {}
+            self._refreshed[rid] = time.time()
+            for _ in range(listings):
+                self._add_listing(rid, expires=self.random.randint(60, 3600))
+
+    def add_random_players(self, count, min_price=200, max_price=500000, first_rid=50000):
+        '''Add players with true prices spread log-uniformly between min_price and max_price'''
+        for i in range(count):
+            p = price.pround(min_price * (max_price / float(min_price)) ** self.random.random())
+            self.add_player(first_rid + i, p, listings=self.random.randint(1, 60))
+
+    @classmethod
+    def from_records(cls, records, seed=None, **kwargs):
+        '''Build a market from recorded listings
+
+        :param records: item dicts as returned by search (resourceId, buyNowPrice and expires are
+            required), or the name of a json file of them.
+        '''
+        if not isinstance(records, list):
+            records = datafile.load_json(records)
+        market = cls(seed=seed, **kwargs)
+        by_rid = {}
+        for r in records:
+            by_rid.setdefault(r['resourceId'], []).append(r)
+        for rid, lst in by_rid.items():
+            market.add_player(rid, min(x['buyNowPrice'] for x in lst), listings=0, **_def_props(lst[0]))
+            for r in lst:
+                market._add_listing(rid, buy_now=r['buyNowPrice'], expires=r['expires'])
+        return market
+
+    def listings(self, rid):
+        '''Live listings of rid, soonest to expire first'''
+        with self._lock:
+            self._refresh(rid)
+            now = time.time()
+            lst = [dict(x, expires=int(x['_expires_at'] - now)) for x in self._books.get(rid, {}).values()]
+        return sorted(lst, key=lambda x: x['expires'])
+
+    def take(self, trade_id, rid):
+        with self._lock:
+            return self._books.get(rid, {}).pop(trade_id, None)
+
+    def make_item(self, rid, **props):
+        item = dict(self.defs[rid])
+        item.update({
+            'id': self.next_id(), 'untradeable': False, 'lastSalePrice': 0, 'loyaltyBonus': 0,
+            'playStyle': 250, 'timestamp': int(time.time()), 'pile': 7,
+            'statsList': [{'index': i, 'value': 0} for i in range(5)],
+            'tradeId': None, 'tradeState': None, 'buyNowPrice': None, 'startingBid': None,
+            'currentBid': None, 'expires': None, 'bidState': None, 'itemState': 'free'
+        })
+        item.update(props)
+        return item
+
+    def _add_listing(self, rid, buy_now=None, expires=3600):
+        if buy_now is None:
+            # most listings are close to the true price, a few are way above it
+            buy_now = price.pincrement(self.true_prices[rid], int(self.random.expovariate(0.2)))
+        trade_id = self.next_id()
+        item = self.make_item(rid, tradeId=trade_id, tradeState='active', buyNowPrice=buy_now,
+                              startingBid=price.pincrement(buy_now, -1), currentBid=0,
+                              itemState='forSale', pile=5)
+        item['_expires_at'] = time.time() + expires
+        self._books[rid][trade_id] = item
+
+    def _refresh(self, rid):
+        if rid not in self._books:
+            return
+        now = time.time()
+        book = self._books[rid]
+        for trade_id in [k for k, x in book.items() if x['_expires_at'] <= now]:
+            del book[trade_id]
+        # new listings since the last refresh
+        elapsed = now - self._refreshed[rid]
+        self._refreshed[rid] = now
+        n = 0
+        t = self.random.expovariate(self.listing_rate)
+        while t < elapsed:
+            n += 1
+            t += self.random.expovariate(self.listing_rate)
+        for _ in range(n):
+            self._add_listing(rid)
+
+
+class SimCore(object):
+    '''In-process stand-in for fut.Core backed by a SimMarket
+
+    Only the calls futme makes are supported, with the same signatures and return values.
+
+    :param latency: (min, max) seconds added to every call.
+    :param rate_limit: (calls, seconds). More calls than that in any window raise FutError,
+        which is what EA does (more or less) before a soft ban.
+    '''
+
+    def __init__(self, market, credits=100000, latency=(0, 0), rate_limit=None,
+                 tradepile_size=100, club_players=0):
+        self.market = market
+        self.credits = credits
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.tradepile_size = tradepile_size
+        self.duplicates = []
+        self.calls = Counter()
+        self.throttled = 0
+        self._call_times = deque()
+        self._lock = threading.RLock()
+        self._tradepile = {}
+        self._unassigned = {}
+        self._club = {}
+        self._consumables = {}
+        rids = list(market.defs)
+        for _ in range(club_players):
+            item = market.make_item(market.random.choice(rids), untradeable=market.random.random() < 0.3)
+            self._club[item['id']] = item
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+            now = time.time()
+            if self.rate_limit is not None:
+                max_calls, window = self.rate_limit
+                while self._call_times and self._call_times[0] <= now - window:
+                    self._call_times.popleft()
+                if len(self._call_times) >= max_calls:
+                    self.throttled += 1
+                    raise fut.exceptions.FutError(code=429, reason='Too many requests')
+                self._call_times.append(now)
+        lo, hi = self.latency
+        if hi > 0:
+            time.sleep(self.market.random.uniform(lo, hi))
+
+    def search(self, ctype, level=None, category=None, assetId=None, defId=None,
+               min_price=None, max_price=None, min_buy=None, max_buy=None,
+               league=None, club=None, position=None, zone=None, nationality=None,
+               rare=False, playStyle=None, start=0, page_size=fut.urls.itemsPerPage['transferMarket'],
+               fast=False):
+        self._call('search')
+        rids = [defId] if defId else [playStyle] if playStyle else list(self.market.defs)
+        result = []
+        for rid in rids:
+            result += [x for x in self.market.listings(rid)
+                       if (max_buy is None or x['buyNowPrice'] <= max_buy) and
+                          (min_buy is None or x['buyNowPrice'] >= min_buy)]
+        result.sort(key=lambda x: x['expires'])
+        return [_public(x) for x in result[start:start + page_size]]
+
+    def bid(self, trade_id, bid, fast=False):
+        self._call('bid')
+        with self._lock:
+            listing = self._find_listing(trade_id)
+            if listing is None:
+                raise fut.exceptions.NoTradeExistingError(478, 'NO_TRADE_EXISTS')
+            if bid < listing['buyNowPrice'] or self.credits < bid:
+                return False
+            self.market.take(trade_id, listing['resourceId'])
+            if self.market.random.random() < self.market.snipe_rate:
+                # too slow, somebody took it already
+                return False
+            self.credits -= bid
+            # the item keeps its id when it changes hands
+            item = self.market.make_item(listing['resourceId'], id=listing['id'], lastSalePrice=bid, pile=6)
+            self._unassigned[item['id']] = item
+            return True
+
+    def sell(self, item_id, bid, buy_now, duration=3600, fast=False):
+        self._call('sell')
+        with self._lock:
+            item = self._tradepile[item_id]
+            item.update({'tradeId': self.market.next_id(), 'tradeState': 'active', 'buyNowPrice': buy_now,
+                         'startingBid': bid, 'currentBid': 0, 'itemState': 'forSale', 'bidState': None,
+                         '_expires_at': time.time() + duration, '_duration': duration})
+            return item['tradeId']
+
+    def tradepile(self):
+        self._call('tradepile')
+        with self._lock:
+            now = time.time()
+            for item in self._tradepile.values():
+                if item['tradeState'] == 'active':
+                    self._settle(item, now)
+                if item['tradeState'] == 'active':
+                    item['expires'] = int(item['_expires_at'] - now)
+            return [_public(x) for x in self._tradepile.values()]
+
+    def _settle(self, item, now):
+        true_price = self.market.true_prices.get(item['resourceId'], 0)
+        if item['buyNowPrice'] <= true_price:
+            # listed at or below the market - someone buys it within a few minutes
+            sold_at = item['_expires_at'] - item['_duration'] + self.market.random.uniform(60, 300)
+            if sold_at <= now:
+                item.update({'tradeState': 'closed', 'currentBid': item['buyNowPrice'], 'expires': -1,
+                             'itemState': 'invalid', 'bidState': 'none'})
+                return
+        if item['_expires_at'] <= now:
+            item.update({'tradeState': 'expired', 'expires': -1, 'itemState': 'free'})
+
+    def tradepileClear(self):
+        self._call('tradepileClear')
+        with self._lock:
+            for item_id in [k for k, x in self._tradepile.items() if x['tradeState'] == 'closed']:
+                self.credits += int(self._tradepile.pop(item_id)['currentBid'] * 0.95)
+
+    def relist(self):
+        self._call('relist')
+        with self._lock:
+            relisted = []
+            for item in self._tradepile.values():
+                if item['tradeState'] == 'expired':
+                    item.update({'tradeState': 'active', 'itemState': 'forSale',
+                                 '_expires_at': time.time() + item['_duration']})
+                    relisted.append({'id': item['tradeId']})
+            return {'tradeIdList': relisted}
+
+    def club(self, sort='desc', ctype='player', defId='', start=0, count=None,
+             page_size=fut.urls.itemsPerPage['club'], level=None, category=None, assetId=None,
+             league=None, club=None, position=None, zone=None, nationality=None, rare=False,
+             playStyle=None):
+        self._call('club')
+        levels = {'gold': (75, 99), 'silver': (65, 74), 'bronze': (0, 64)}
+        with self._lock:
+            items = [x for x in self._club.values()
+                     if (not defId or x['resourceId'] == defId) and
+                        (level is None or levels[level][0] <= x['rating'] <= levels[level][1]) and
+                        (league is None or x['leagueId'] == league) and
+                        (club is None or x['teamid'] == club) and
+                        (nationality is None or x['nation'] == nationality) and
+                        (not rare or x['rareflag'] > 1)]
+        items.sort(key=lambda x: (x['rating'], x['id']), reverse=(sort == 'desc'))
+        return [dict(x) for x in items[start:start + (count or page_size)]]
+
+    def clubConsumables(self, fast=False):
+        self._call('clubConsumables')
+        with self._lock:
+            return [dict(x) for x in self._consumables.values()]
+
+    def unassigned(self):
+        self._call('unassigned')
+        with self._lock:
+            return [dict(x) for x in self._unassigned.values()]
+
+    def buyPack(self, pack_id, currency='COINS'):
+        self._call('buyPack')
+        coins, size = PACKS[pack_id]
+        with self._lock:
+            if self.credits < coins:
+                raise fut.exceptions.FutError(code=470, reason='Not enough credits')
+            self.credits -= coins
+            rids = list(self.market.defs)
+            for _ in range(size):
+                rid = self.market.random.choice(rids)
+                item = self.market.make_item(rid, pile=6, untradeable=True)
+                if any(x['resourceId'] == rid for x in self._club.values()):
+                    self.duplicates.append(item['id'])
+                self._unassigned[item['id']] = item
+        return {'credits': self.credits}
+
+    def sendToTradepile(self, item_id, safe=True):
+        self._call('sendToTradepile')
+        with self._lock:
+            if safe and len(self._tradepile) >= self.tradepile_size:
+                return False
+            item = self._take_item(item_id)
+            if item is None:
+                return False
+            item.update({'pile': 5, 'tradeId': 0, 'tradeState': None, 'buyNowPrice': 0, 'expires': 0})
+            self._tradepile[item_id] = item
+            return True
+
+    def sendToClub(self, item_id):
+        self._call('sendToClub')
+        with self._lock:
+            for i in (item_id if isinstance(item_id, list) else [item_id]):
+                item = self._take_item(i)
+                if item is not None:
+                    item['pile'] = 7
+                    self._club[i] = item
+            return True
+
+    def quickSell(self, item_id):
+        self._call('quickSell')
+        with self._lock:
+            for i in (item_id if isinstance(item_id, list) else [item_id]):
+                item = self._take_item(i)
+                if item is not None:
+                    self.credits += item['discardValue']
+            return True
+
+    def keepalive(self):
+        self._call('keepalive')
+        return self.credits
+
+    def searchDefinition(self, asset_id, start=0, page_size=fut.urls.itemsPerPage['transferMarket'], count=None):
+        self._call('searchDefinition')
+        return [self.market.make_item(d['resourceId'], id=d['resourceId'])
+                for d in self.market.defs.values() if d['assetId'] == asset_id]
+
+    def logout(self, save=True):
+        self._call('logout')
+
+    def __request__(self, method, url, data=None, params=None, fast=False):
+        # only used to redeem unassigned items (coins and packs)
+        self._call('__request__')
+        with self._lock:
+            item = self._take_item(int(url.split('/')[-1]))
+            if item is not None:
+                self.credits += item['discardValue']
+        return {}
+
+    def _take_item(self, item_id):
+        for pile in (self._unassigned, self._tradepile, self._club):
+            if item_id in pile:
+                return pile.pop(item_id)
+        return None
+
+    def _find_listing(self, trade_id):
+        for book in self.market._books.values():
+            if trade_id in book:
+                return book[trade_id]
+        return None
+
+
+class SimLookups(Lookups):
+    '''Lookups generated from a SimMarket, without touching the network or ~/.futme
+
+    Only the loading is replaced. The stores and the player index are those of Lookups.
+    '''
+
+    def __init__(self, market):
+        self.market = market
+        super(SimLookups, self).__init__()
+
+    def _init_data(self, force_reload):
+        self.nations.items = [_lookup_item(i, 'Nation') for i in range(1, 201)]
+        self.leagues.items = [_lookup_item(i, 'League') for i in range(1, 61)]
+        self.teams.items   = [_lookup_item(i, 'Team') for i in range(1, 701)]
+
+    def _load_players(self):
+        return {d['assetId']: {'id': d['assetId'], 'firstname': 'Player', 'lastname': str(d['assetId']),
+                               'surname': None, 'rating': d['rating']}
+                for d in self.market.defs.values()}
+
+
+class SimFutbin(object):
+    '''Answers futbin price requests (price.quick and price.history) from a SimMarket
+
+    Quick prices and daily graphs are the true price plus some noise.
+
+    price.futbin_client = SimFutbin(market)
+    '''
+
+    def __init__(self, market):
+        self.market = market
+
+    def get_json(self, url):
+        u = urlparse(url)
+        q = parse_qs(u.query)
+        rid = int(q['player'][0])
+        if rid not in self.market.true_prices:
+            raise ValueError('No player {} in the market'.format(rid))
+        true_price = self.market.true_prices[rid]
+        rnd = random.Random(rid)
+        if u.path.endswith('playerPrices'):
+            quick = price.pround(true_price * rnd.uniform(0.9, 1.15))
+            return {str(rid): {'prices': {'ps': {'LCPrice': '{:,}'.format(quick)}}}}
+        now = int(time.time())
+        if q['type'][0] == 'daily_graph':
+            points = [(now - d * 86400, true_price * rnd.uniform(0.8, 1.25)) for d in range(90)]
+        else:
+            points = [(now - h * 3600, true_price * rnd.uniform(0.95, 1.05)) for h in range(24)]
+        return {'ps': [[t * 1000, price.pround(v)] for t, v in points]}
+
+def _public(item):
+    return {k: v for k, v in item.items() if not k.startswith('_')}
+
+def _def_props(record):
+    keys = ['assetId', 'rating', 'rareflag', 'position', 'teamid', 'leagueId', 'nation',
+            'discardValue', 'marketDataMinPrice', 'marketDataMaxPrice']
+    return {k: record[k] for k in keys if k in record}
+
+def _lookup_item(i, prefix):
+    return {'id': i, 'name': '{} {}'.format(prefix, i), 'abbr': '{}{}'.format(prefix[0], i), 'abbr2': None}
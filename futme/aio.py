@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class AsyncSession(object):
+    '''Async adapter for the blocking FUT session
+
+    Calls run in a thread pool of `concurrency` threads, which is also the limit on how
+    many tasks run at once across all coroutines using the adapter.
+
+    asession = AsyncSession(fme, concurrency=4)
+    await asession.run(trader.attempt)
+
+    The session itself makes one FUT call at a time (see governor.GovernedSession). What
+    overlaps is everything else a task does: waiting for rate budgets, futbin requests...
+    '''
+
+    def __init__(self, fme, concurrency=4):
+        self.fme = fme
+        self.concurrency = concurrency
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    async def run(self, func, *args, **kwargs):
+        '''Run a blocking function (anything that calls the session) in the pool'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+async def run_worker(worker, asession):
+    '''Run the tasks of a LoopyWorker as they become due, until it has no tasks left
+
+    The tasks themselves are blocking, so they run in the AsyncSession's pool. A slow task
+    only holds up the other tasks of the same worker.
+    '''
+    while worker.tasks:
+        task = min(worker.tasks, key=lambda t: t.next_run_time())
+        delay = task.next_run_time() - time.time()
+        if delay > 0:
+            # re-evaluate after sleeping - intervals may change and tasks may be removed
+            await asyncio.sleep(min(delay, 1))
+        elif worker.paused:
+            await asyncio.sleep(1)
+        else:
+            await asession.run(task.execute)
+
+async def run_autotrader(autotrader, asession):
+    '''Run an AutoTrader with each trader as its own coroutine'''
+    running = {}
+    try:
+        while True:
+            # pick up the traders created (and drop the ones removed) by reload_conf
+            for t in [autotrader] + autotrader.traders:
+                if t not in running and t.worker.tasks:
+                    running[t] = asyncio.ensure_future(run_worker(t.worker, asession))
+            for t in [x for x in running if x is not autotrader and x not in autotrader.traders]:
+                running.pop(t).cancel()
+            for t, f in list(running.items()):
+                if f.done():
+                    if f.exception() is not None:
+                        raise f.exception()
+                    # out of tasks. started again above if it gets new ones
+                    del running[t]
+            await asyncio.sleep(1)
+    finally:
+        for f in running.values():
+            f.cancel()
+
+async def run_autotraders(autotraders, fme, concurrency=4):
+    asession = AsyncSession(fme, concurrency)
+    try:
+        await asyncio.gather(*[run_autotrader(at, asession) for at in autotraders])
+    finally:
+        asession.shutdown()
+
+def run_in_thread(coro):
+    '''Run a coroutine in its own event loop on a daemon thread
+
+    :return: a concurrent.futures.Future of the result (or the exception that ended it)
+    '''
+    future = concurrent.futures.Future()
+    def target():
+        try:
+            future.set_result(asyncio.run(coro))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=target, name='futme-aio', daemon=True).start()
+    return future
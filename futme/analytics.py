@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+from . import price, timeutil
+
+logger = logging.getLogger(__name__)
+
+class PriceMatrix(object):
+    '''Daily prices of many cards as a cards x days matrix
+
+    Row i is the card rids[i], and column d its price d days ago (the latest point of that
+    day), or nan if there is none. All stats are computed for all cards at once, and are nan
+    for cards without enough points in the window.
+
+    m = PriceMatrix(price.history_many(players))
+    m.high(7), m.low(7), m.trade_score([p['lastSalePrice'] for p in players])
+    '''
+
+    def __init__(self, histories, days=90, now=None):
+        '''
+        :param histories: dict of resourceId -> PriceHistory
+        '''
+        now = time.time() if now is None else now
+        self.rids = list(histories)
+        self.days = days
+        self.prices = np.full((len(self.rids), days), np.nan)
+        for i, rid in enumerate(self.rids):
+            timestamps, values = histories[rid].columns()
+            age = ((now - timestamps) // timeutil.SECONDS_PER_DAY).astype(np.int64)
+            # latest first, so that np.unique picks the latest point of each day
+            age, values = age[::-1], values[::-1]
+            keep = (age >= 0) & (age < days)
+            age, first = np.unique(age[keep], return_index=True)
+            self.prices[i, age] = values[keep][first]
+
+    def window(self, days):
+        return self.prices[:, :days]
+
+    def high(self, days):
+        return _nan_quietly(np.nanmax, self.window(days), axis=1)
+
+    def low(self, days):
+        return _nan_quietly(np.nanmin, self.window(days), axis=1)
+
+    def mean(self, days):
+        return _nan_quietly(np.nanmean, self.window(days), axis=1)
+
+    def stdev(self, days):
+        return _nan_quietly(np.nanstd, self.window(days), axis=1, ddof=1)
+
+    def trade_score(self, prices, days=90):
+        '''How many stdevs each of prices is away from the mean of its card'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.round((np.asarray(prices, dtype=float) - self.mean(days)) / self.stdev(days), 1)
+
+    def volatility(self, days=30):
+        '''Stdev of the day to day price changes, in %'''
+        oldest_first = self.window(days)[:, ::-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            changes = np.diff(np.log(oldest_first), axis=1)
+        return _nan_quietly(np.nanstd, changes, axis=1, ddof=1) * 100
+
+    def trend(self, days=30):
+        '''Slope of the least squares line through the prices, in % of the mean price per day'''
+        y = self.window(days)
+        known = ~np.isnan(y)
+        x = np.where(known, -np.arange(days, dtype=float), 0)
+        n = known.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_mean = x.sum(axis=1) / n
+            y_mean = _nan_quietly(np.nanmean, y, axis=1)
+            dx = np.where(known, x - x_mean[:, None], 0)
+            dy = np.where(known, y - y_mean[:, None], 0)
+            slope = (dx * dy).sum(axis=1) / (dx * dx).sum(axis=1)
+            return slope / y_mean * 100
+
+    def table(self, prices=None):
+        '''A PriceTable of the usual stats, plus the trade scores of prices if given'''
+        columns = OrderedDict()
+        if prices is not None:
+            columns['price'] = np.asarray(prices, dtype=float)
+        for days in (7, 30, 90):
+            columns['hi{}d'.format(days)] = self.high(days)
+            columns['lo{}d'.format(days)] = self.low(days)
+        for days in (30, 90):
+            columns['mean{}d'.format(days)] = self.mean(days)
+            columns['sd{}d'.format(days)] = self.stdev(days)
+        if prices is not None:
+            columns['ts'] = self.trade_score(prices)
+        columns['vol30d'] = self.volatility(30)
+        columns['trend30d'] = self.trend(30)
+        return PriceTable(self.rids, columns)
+
+
+class PriceTable(object):
+    '''Per card price stats, as named numpy columns in the order of rids'''
+
+    def __init__(self, rids, columns):
+        self.rids = rids
+        self.columns = columns
+        self._rows = {rid: i for i, rid in enumerate(rids)}
+
+    def __len__(self):
+        return len(self.rids)
+
+    def get(self, rid, name):
+        '''The value of column name for rid as an int (prices) or float, or None if unknown'''
+        v = self.columns[name][self._rows[rid]]
+        if np.isnan(v):
+            return None
+        return int(v) if name.startswith(('price', 'hi', 'lo')) else round(float(v), 1)
+
+    def fmt(self, rid, name):
+        '''The value of column name for rid for display: '-' if unknown'''
+        v = self.get(rid, name)
+        return '-' if v is None else str(v)
+
+    def row(self, rid):
+        return OrderedDict((name, self.get(rid, name)) for name in self.columns)
+
+    def to_rows(self):
+        '''Header and one row per card, e.g. for datafile.save_tsv'''
+        rows = [['rid'] + list(self.columns)]
+        for rid in self.rids:
+            rows.append([rid] + ['' if v is None else v for v in self.row(rid).values()])
+        return rows
+
+
+def price_table(players, prices=None, days=90):
+    '''PriceTable of players (dicts or resourceIds), with histories fetched concurrently
+
+    :param prices: (optional) dict of resourceId -> current price for the trade scores
+    '''
+    m = PriceMatrix(price.history_many(players), days)
+    return m.table(None if prices is None else [prices[rid] for rid in m.rids])
+
+def _nan_quietly(func, a, **kwargs):
+    # all-nan rows (cards without points in the window) are expected. they just give nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return func(a, **kwargs)
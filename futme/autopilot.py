@@ -5,11 +5,11 @@ import time
 
 import fut
 
-from . import datafile
+from . import aio, datafile, metrics
 from .autotrader import AutoTrader
 from .core import Futme
 from .util import sms
-from .worker import LoopyWorker
+from .worker import LoopyWorker, Scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -20,27 +20,39 @@ class AutoPilot:
         self.conf = datafile.load_json(conf_file)
         self.min_coins = self.conf['min_coins']
 
-        self.worker = LoopyWorker()
+        # one scheduler runs the autopilot tasks and the tasks of all traders
+        self.scheduler = Scheduler()
+        self.worker = LoopyWorker(self.scheduler)
         self.reg_task('status', self.print_status)
         self.reg_task('refresh_tradepile', self.fme.proc.refresh_tradepile)
         self.reg_task('packs', self.fme.proc.packs)
         self.reg_task('consumeables', self.fme.proc.sell_excess_consumables)
         self.reg_task('check_traders', self.check_traders)
+        self.reg_task('metrics', self.write_metrics)
 
-        self.buyers = AutoTrader(self.fme, self.conf['autotraders']['buyers'])
-        self.flippers = AutoTrader(self.fme, self.conf['autotraders']['flippers'])
+        # with "async_traders": {"concurrency": n} in the conf, each trader runs as its own
+        # coroutine (see aio) instead of taking turns in the scheduler
+        self.async_conf = self.conf.get('async_traders')
+        trader_scheduler = self.scheduler if self.async_conf is None else None
+        self.buyers = AutoTrader(self.fme, self.conf['autotraders']['buyers'], trader_scheduler)
+        self.flippers = AutoTrader(self.fme, self.conf['autotraders']['flippers'], trader_scheduler)
+        self.async_traders = None
 
         self.round = 0
 
 
     def run(self):
         try:
+            if self.async_conf is not None:
+                self.async_traders = aio.run_in_thread(aio.run_autotraders(
+                    [self.buyers, self.flippers], self.fme, self.async_conf.get('concurrency', 4)))
             while True:
                 self.round += 1
-                self.worker.run()
-                self.buyers.run()
-                self.flippers.run()
-                time.sleep(1)
+                self.scheduler.run_pending()
+                if self.async_traders is not None and self.async_traders.done():
+                    # the traders only stop on error. raise it here
+                    self.async_traders.result()
+                self.scheduler.sleep(max_seconds=1 if self.async_traders is not None else 60)
         except Exception as e:
             logger.exception('Error in autopilot main loop')
             sms(repr(e))
@@ -55,11 +67,17 @@ class AutoPilot:
     def print_status(self):
         coins = self.fme.session().keepalive()
         logger.info('Round %s: coins=%s', self.round, coins)
+        logger.info('FUT calls: %s', self.fme.governor.stats_str())
         if coins < self.min_coins:
             logger.error('Only %s coins left. Shutting down now.', coins)
             self.fme.shutdown()
             exit(1)
 
+    def write_metrics(self):
+        # for the node_exporter textfile collector, or anything else that reads the format
+        path = self.conf['metrics'].get('file', datafile.dbfilepath('futme.prom'))
+        metrics.registry.write_prometheus(path)
+
     def check_traders(self):
         active_buyers = len([x for x in self.buyers.traders if x.state == 'active'])
         if active_buyers >= 3:
@@ -6,19 +6,24 @@ import time
 import fut
 from beaker.cache import cache_region, cache_regions, region_invalidate
 
-from . import core, datafile, display, price, timeutil, worker, util
+from . import core, datafile, display, governor, metrics, price, timeutil, worker, util
 
 logger = logging.getLogger(__name__)
 
 class AutoTrader:
 
-    def __init__(self, fme, conf_file):
+    def __init__(self, fme, conf_file, scheduler=None):
+        '''
+        :param scheduler: (optional) a worker.Scheduler to run the tasks of the AutoTrader and all
+            its traders. run() polls them instead if not given.
+        '''
         self.fme = fme
         self.conf_file = conf_file
+        self.scheduler = scheduler
 
         self.traders = self.create_traders()
         self.conf_last_modified = datafile.last_modified(self.conf_file)
-        self.worker = worker.LoopyWorker()
+        self.worker = worker.LoopyWorker(scheduler)
         self.worker.register_task('status', self.print_trader_statuses, 1200)
         self.worker.register_task('reload_conf', self.reload_conf, 60, delay=60)
         self.enabled = True
@@ -35,9 +40,9 @@ class AutoTrader:
                         pdef = self.validate_trader_conf(c)
                         if pdef is not None:
                             if ttype == 'buy':
-                                traders.append(Buyer(self.fme, pdef, c))
+                                traders.append(Buyer(self.fme, pdef, c, self.scheduler))
                             elif ttype == 'flip':
-                                traders.append(Flipper(self.fme, pdef, c))
+                                traders.append(Flipper(self.fme, pdef, c, self.scheduler))
         logger.info('%s traders initialized from %s:', len(traders), self.conf_file)
         self.print_trader_confs(traders)
         return traders
@@ -72,11 +77,16 @@ class AutoTrader:
     def disable(self):
         if self.enabled:
             self.enabled = False
+            for t in self.traders:
+                t.worker.pause()
             logger.warning('AutoTrader (%s) disabled', self.conf_file)
 
     def enable(self):
         if not self.enabled:
             self.enabled = True
+            for t in self.traders:
+                if t.state != 'complete':
+                    t.worker.resume()
             logger.warning('AutoTrader (%s) enabled', self.conf_file)
 
     def print_trader_statuses(self):
@@ -88,20 +98,28 @@ class AutoTrader:
         for t in self.traders:
             ttype = t.trader_type()
             state = t.state[0].upper()
-            logging.info(self.fme.disp.sprint(sfmt, t.pdef, ttype, state, t.status_str()))
+            status = '{} ({})'.format(t.status_str(), t.worker.stats)
+            logging.info(self.fme.disp.sprint(sfmt, t.pdef, ttype, state, status))
+        for line in metrics.registry.summary('fut') + metrics.registry.summary('http'):
+            logger.info('  %s', line)
 
     def reload_conf(self):
         mtime = datafile.last_modified(self.conf_file)
         if mtime > self.conf_last_modified:
             logger.info('Reloading %s - it was modified %s ago',
                         self.conf_file, timeutil.dur_str(time.time() - mtime))
+            for t in self.traders:
+                t.worker.unregister_all()
             self.traders = self.create_traders()
+            if not self.enabled:
+                for t in self.traders:
+                    t.worker.pause()
             self.conf_last_modified = mtime
 
 
 class BaseTrader:
 
-    def __init__(self, fme, pdef, conf):
+    def __init__(self, fme, pdef, conf, scheduler=None):
         self.fme = fme
         self.pdef = pdef
         self.rid = pdef['resourceId']
@@ -116,7 +134,7 @@ class BaseTrader:
         self.mkt_price = 0
         self.attempts = 0
 
-        self.worker = worker.LoopyWorker()
+        self.worker = worker.LoopyWorker(scheduler)
         self.state = 'active'
 
     def run(self):
@@ -130,13 +148,7 @@ class BaseTrader:
                 self.bid = 0
             else:
                 self.mkt_price = mp
-                discounted_price = price.pround(self.mkt_price * self.discount)
-                if self.suggested_bid == 0:
-                    adjusted_bid = discounted_price
-                else:
-                    adjusted_bid = min(self.suggested_bid, discounted_price)
-                min_price = price.pincrement(p['discardValue'])
-                self.bid = max(min_price, adjusted_bid)
+                self.bid = flex_bid(mp, self.discount, self.suggested_bid, p['discardValue'])
         else:
             self.bid = self.suggested_bid
 
@@ -147,6 +159,8 @@ class BaseTrader:
             logger.warning('%s  State change: %s -> %s%s',
                            self.trader_name(), self.state, new_state, reason)
             self.state = new_state
+            if new_state == 'complete':
+                self.worker.unregister_all()
 
     def trader_type(self):
         return type(self).__name__[0].upper()
@@ -161,8 +175,8 @@ class BaseTrader:
 
 class Buyer(BaseTrader):
 
-    def __init__(self, fme, pdef, conf):
-        super().__init__(fme, pdef, conf)
+    def __init__(self, fme, pdef, conf, scheduler=None):
+        super().__init__(fme, pdef, conf, scheduler)
         self.quick_price = 0
         self.quantity = conf['quantity']
         self.bought = []
@@ -174,13 +188,16 @@ class Buyer(BaseTrader):
         self.quick_price = price.quick(self.rid)
 
     def attempt(self):
-        if self.bid == 0:
-            self.set_state('paused', 'nothing in market')
+        reason = buy_check(self.bid)
+        if reason is not None:
+            self.set_state('paused', reason)
             return
 
         self.set_state('active')
         self.attempts += 1
-        won = self.fme.tm.buy_now(self.rid, self.bid)
+        # the searches of an attempt are part of the bid. they go before price discovery
+        with self.fme.governor.priority(governor.BID):
+            won = self.fme.tm.buy_now(self.rid, self.bid, observer=self)
         if won is not None:
             item_id = won['id']
             un = self.fme.session().unassigned()
@@ -189,6 +206,7 @@ class Buyer(BaseTrader):
                 self.fme.session().sendToTradepile(item_id)
             else:
                 self.fme.session().sendToClub(item_id)
+                self.fme.club.snapshot.added(self.bought[-1:])
             if len(self.bought) == self.quantity:
                 self.set_state('complete')
 
@@ -203,46 +221,32 @@ class Buyer(BaseTrader):
 
 class Flipper(BaseTrader):
 
-    def __init__(self, fme, pdef, conf):
-        super().__init__(fme, pdef, conf)
+    def __init__(self, fme, pdef, conf, scheduler=None):
+        super().__init__(fme, pdef, conf, scheduler)
         self.maxflips = conf['maxflips']
         self.sellfor = conf['sellfor']
         self.worker.register_task('update_bid', self.update_bid, 1200)
         self.worker.register_task('attempt', self.attempt, self.interval)
 
     def attempt(self):
-        if self.bid == 0:
-            self.set_state('paused', 'nothing in market')
-            return
-
-        # no more than configured active flips (default 2) for an item at any give time
-        num_listed = self._num_listed()
-        if num_listed >= self.maxflips:
-            self.set_state('paused', '{} active flips. {} max'.format(num_listed, self.maxflips))
-            return
-
-        # should not sell for loss
-        if self.sellfor != 0 and self.sellfor < self.bid:
-            self.set_state('paused',
-                           'sellfor ({}) is less than bid ({})'.format(self.sellfor, self.bid))
+        reason = flip_check(self.bid, self._num_listed() if self.bid != 0 else 0, self.maxflips, self.sellfor)
+        if reason is not None:
+            self.set_state('paused', reason)
             return
 
         self.set_state('active')
         self.attempts += 1
-        won = self.fme.tm.buy_now(self.rid, self.bid)
+        with self.fme.governor.priority(governor.BID):
+            won = self.fme.tm.buy_now(self.rid, self.bid, observer=self)
         if won is not None:
             # get current market price - we are not selling for less
             _, current_mkt_price, _ = self.fme.tm.search_min_price(self.rid)
-            if self.sellfor != 0:
-                self.fme.tm.sell(won['id'], max(self.sellfor, current_mkt_price))
-            else:
-                self.fme.tm.sell(won['id'], max(self.mkt_price, current_mkt_price))
+            self.fme.tm.sell(won['id'], flip_sell_price(self.sellfor, self.mkt_price, current_mkt_price))
             # TODO update mkt_price and bid
 
     def _num_listed(self):
         '''Returns the number of active listings'''
-        lst = self.fme.tm.tradepile.active() + self.fme.tm.tradepile.expired()
-        return len([x for x in lst if x['resourceId'] == self.rid])
+        return len(self.fme.tm.tradepile.by_rid(self.rid, ['active', 'expired']))
 
     def conf_str(self):
         return self._conf_str('interval', 'discount', 'bid', 'flexbid', 'maxflips', 'sellfor')
@@ -251,6 +255,39 @@ class Flipper(BaseTrader):
         return 'bid={} mp={} atps={}'.format(self.bid, self.mkt_price, self.attempts)
 
 
+# the decisions of the traders, kept free of FUT calls so that backtest can replay them
+
+def flex_bid(mkt_price, discount, suggested_bid, discard_value):
+    '''The bid of a flexbid trader: mkt_price at discount, capped by suggested_bid (if not 0)'''
+    discounted_price = price.pround(mkt_price * discount)
+    if suggested_bid == 0:
+        adjusted_bid = discounted_price
+    else:
+        adjusted_bid = min(suggested_bid, discounted_price)
+    # never bid at or below what the card quick sells for
+    return max(price.pincrement(discard_value), adjusted_bid)
+
+def buy_check(bid):
+    '''None if a Buyer should attempt to buy at bid, or why it should pause'''
+    return 'nothing in market' if bid == 0 else None
+
+def flip_check(bid, num_listed, maxflips, sellfor):
+    '''None if a Flipper should attempt to buy at bid, or why it should pause'''
+    if bid == 0:
+        return 'nothing in market'
+    # no more than configured active flips (default 2) for an item at any give time
+    if num_listed >= maxflips:
+        return '{} active flips. {} max'.format(num_listed, maxflips)
+    # should not sell for loss
+    if sellfor != 0 and sellfor < bid:
+        return 'sellfor ({}) is less than bid ({})'.format(sellfor, bid)
+    return None
+
+def flip_sell_price(sellfor, mkt_price, current_mkt_price):
+    '''What a Flipper lists a card it has just bought for - never less than the market price now'''
+    return max(sellfor if sellfor != 0 else mkt_price, current_mkt_price)
+
+
 def main():
     logging.basicConfig(
         format='%(asctime)s %(levelname)-8s %(message)s',
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+'''Replays stored price history through the Buyer and Flipper decisions
+
+python -m futme.backtest 50331648 flip --days 7 --discount 0.85 0.9 0.95 --interval 5 60 --maxflips 1 2 4
+python -m futme.backtest 50331648 buy --discount 0.8 0.9 --quantity 3
+'''
+
+import argparse
+import bisect
+import concurrent.futures
+import itertools
+import logging
+import math
+import random
+
+import numpy as np
+
+from . import autotrader, price, timeutil
+
+logger = logging.getLogger(__name__)
+
+# EA keeps 5% of every sale
+TAX = 0.05
+# how long a flip is listed for (TransferMarket.sell), and how long an expired listing
+# waits for the autopilot's refresh_tradepile to relist it at the same price
+LISTING_DURATION = 3600
+RELIST_DELAY = 600
+# trader task intervals and the FUT calls of the tasks (see TransferMarket.search_stats
+# for the searches it really takes to find a market price)
+UPDATE_BID_INTERVAL = 1200
+SEARCHES_PER_PRICE = 3
+
+class PriceTrack(object):
+    '''The market price of a card over time: each point holds until the next one'''
+
+    def __init__(self, timestamps, values):
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.int64)
+        # plain lists for the per step lookups: bisect on them beats numpy calls on scalars
+        self._ts = self.timestamps.tolist()
+        self._vs = self.values.tolist()
+
+    @classmethod
+    def from_store(cls, rid, days=None):
+        '''The daily, hourly and market prices of rid in the price store, as they are'''
+        h = price.stored_history(rid, include_hourly=3)
+        if days is not None:
+            h = h.slice(days)
+        return cls(*h.columns())
+
+    def start(self):
+        return int(self.timestamps[0])
+
+    def end(self):
+        return int(self.timestamps[-1])
+
+    def at(self, t):
+        i = bisect.bisect_right(self._ts, t) - 1
+        return self._vs[i] if i >= 0 else 0
+
+    def first_at_or_above(self, p, t1, t2):
+        '''The time of the first price point in (t1, t2] at p or more, or None
+
+        A listing made at t1 sells when the market next moves to (or past) its price.
+        '''
+        for i in range(bisect.bisect_right(self._ts, t1), bisect.bisect_right(self._ts, t2)):
+            if self._vs[i] >= p:
+                return self._ts[i]
+        return None
+
+
+class Market(object):
+    '''What a buy attempt finds: the cheapest listing is the market price times a random
+    spread, and another buyer beats us to it with probability snipe_loss'''
+
+    def __init__(self, track, spread=0.08, snipe_loss=0.5, seed=0):
+        self.track = track
+        self.spread = spread
+        self.snipe_loss = snipe_loss
+        self.random = random.Random(seed)
+
+    def cheapest(self, t):
+        m = self.track.at(t)
+        return price.pround(m * math.exp(self.random.gauss(0, self.spread))) if m else 0
+
+    def outbid(self):
+        return self.random.random() < self.snipe_loss
+
+
+def run_buyer(track, conf, **market_args):
+    '''Replays a Buyer with conf (the same keys as in the autotrader json) over track'''
+    market = Market(track, **market_args)
+    requests = 0
+    bid, bought, paid, at_market = 0, 0, [], []
+    next_update = track.start()
+    t = track.start()
+    while t < track.end() and bought < conf['quantity']:
+        if t >= next_update:
+            bid, n = _update_bid(track, conf, t)
+            requests += n
+            next_update = t + UPDATE_BID_INTERVAL
+        if autotrader.buy_check(bid) is not None:
+            # nothing to do until the next update_bid
+            t = _skip(t, next_update, conf['interval'])
+            continue
+        requests += 1
+        listing = market.cheapest(t)
+        if 0 < listing <= bid:
+            requests += 1
+            if not market.outbid():
+                # unassigned, then sendToClub
+                requests += 2
+                bought += 1
+                paid.append(listing)
+                at_market.append(track.at(t))
+        t += conf['interval']
+    spent = sum(paid)
+    return {
+        'bought': bought,
+        'spent': spent,
+        'avg_paid': spent // bought if bought else None,
+        'saved_pct': round(100.0 * (1 - spent / float(sum(at_market))), 1) if bought else None,
+        'hours': round((t - track.start()) / float(timeutil.SECONDS_PER_HOUR), 1),
+        'requests': requests
+    }
+
+def run_flipper(track, conf, **market_args):
+    '''Replays a Flipper with conf (the same keys as in the autotrader json) over track
+
+    Flips still listed at the end are valued at the last market price, less tax.
+    '''
+    market = Market(track, **market_args)
+    requests = 0
+    bid, mkt_price = 0, 0
+    flips = []
+    # flips not sold yet, as of t
+    listed = []
+    next_update = track.start()
+    t = track.start()
+    while t < track.end():
+        if t >= next_update:
+            bid, n = _update_bid(track, conf, t)
+            mkt_price = track.at(t) if bid else 0
+            requests += n
+            next_update = t + UPDATE_BID_INTERVAL
+        listed = [f for f in listed if f['sold_at'] is None or f['sold_at'] > t]
+        if bid == 0:
+            t = _skip(t, next_update, conf['interval'])
+            continue
+        # the tradepile, for the number of active flips
+        requests += 1
+        if autotrader.flip_check(bid, len(listed), conf['maxflips'], conf['sellfor']) is not None:
+            # nothing changes until the next update_bid or the next sale. every attempt
+            # in between still loads the tradepile
+            until = min([next_update, track.end()] + [f['sold_at'] for f in listed if f['sold_at'] is not None])
+            skipped = _skip(t, until, conf['interval'])
+            requests += (skipped - t) // conf['interval'] - 1
+            t = skipped
+            continue
+        requests += 1
+        listing = market.cheapest(t)
+        if 0 < listing <= bid:
+            requests += 1
+            if not market.outbid():
+                # search_min_price, sendToTradepile and sell
+                requests += SEARCHES_PER_PRICE + 2
+                list_price = autotrader.flip_sell_price(conf['sellfor'], mkt_price, track.at(t))
+                flip = _list(track, listing, list_price, t)
+                requests += flip['relists']
+                flips.append(flip)
+                listed.append(flip)
+        t += conf['interval']
+
+    end = track.end()
+    sold = [f for f in flips if f['sold_at'] is not None]
+    unsold = [f for f in flips if f['sold_at'] is None]
+    profit = sum(int(f['list_price'] * (1 - TAX)) - f['paid'] for f in sold)
+    unsold_value = sum(int(track.at(end) * (1 - TAX)) - f['paid'] for f in unsold)
+    # coins tied up in flips: total coin-hours, and the most at any one time
+    spans = [(f['bought_at'], f['sold_at'] or end, f['paid']) for f in flips]
+    coin_hours = sum((b - a) * p for a, b, p in spans) / float(timeutil.SECONDS_PER_HOUR)
+    events = sorted([(a, p) for a, _, p in spans] + [(b, -p) for _, b, p in spans])
+    locked = peak = 0
+    for _, p in events:
+        locked += p
+        peak = max(peak, locked)
+    return {
+        'flips': len(flips),
+        'sold': len(sold),
+        'profit': profit,
+        'profit_incl_unsold': profit + unsold_value,
+        'peak_locked': peak,
+        'coin_hours': int(coin_hours),
+        'requests': requests,
+        'profit_per_request': round(profit / float(requests), 1) if requests else 0
+    }
+
+def _update_bid(track, conf, t):
+    '''The bid a trader's update_bid task comes up with at t, and the FUT calls it takes'''
+    if not conf['flexbid']:
+        return conf['bid'], 0
+    mkt_price = track.at(t)
+    if mkt_price == 0:
+        return 0, SEARCHES_PER_PRICE
+    return autotrader.flex_bid(mkt_price, conf['discount'], conf['bid'], conf.get('discardValue', 0)), SEARCHES_PER_PRICE
+
+def _skip(t, until, interval):
+    # the first attempt at or after until, or the next one if that is t itself
+    return t + max(1, -(-(until - t) // interval)) * interval
+
+def _list(track, paid, list_price, t):
+    # listed at t, relisted at the same price every time it expires, until it sells
+    listed_at, relists = t, 0
+    while listed_at < track.end():
+        sold_at = track.first_at_or_above(list_price, listed_at, listed_at + LISTING_DURATION)
+        if sold_at is not None:
+            return {'paid': paid, 'list_price': list_price, 'bought_at': t, 'sold_at': sold_at, 'relists': relists}
+        listed_at += LISTING_DURATION + RELIST_DELAY
+        relists += 1
+    return {'paid': paid, 'list_price': list_price, 'bought_at': t, 'sold_at': None, 'relists': relists}
+
+
+RUNNERS = {'buy': run_buyer, 'flip': run_flipper}
+
+def sweep(track, ttype, base_conf, grid, processes=None, **market_args):
+    '''Runs every combination of the values in grid (conf key -> list of values) over track
+
+    The runs are spread over a process pool of processes processes (one per cpu by default).
+    :return: a list of (conf, result), in the order of the combinations
+    '''
+    keys = sorted(grid)
+    confs = [dict(base_conf, **dict(zip(keys, values))) for values in itertools.product(*[grid[k] for k in keys])]
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        futures = [executor.submit(RUNNERS[ttype], track, c, **market_args) for c in confs]
+        return [(c, f.result()) for c, f in zip(confs, futures)]
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        datefmt='%m-%d %H:%M:%S',
+        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Backtest Buyer and Flipper confs against stored prices')
+    parser.add_argument('rid', type=int)
+    parser.add_argument('ttype', help='buy or flip')
+    parser.add_argument('--days', type=int, default=7, help='how much of the stored history to replay')
+    parser.add_argument('--discount', type=float, nargs='+', default=[0.9])
+    parser.add_argument('--interval', type=int, nargs='+', default=[5])
+    parser.add_argument('--bid', type=int, nargs='+', default=[0])
+    parser.add_argument('--maxflips', type=int, nargs='+', default=[2])
+    parser.add_argument('--sellfor', type=int, nargs='+', default=[0])
+    parser.add_argument('--quantity', type=int, nargs='+', default=[1])
+    parser.add_argument('--spread', type=float, default=0.08, help='stdev of the cheapest listing vs market price')
+    parser.add_argument('--snipe-loss', type=float, default=0.5, help='chance someone else buys it first')
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+    if args.ttype not in RUNNERS:
+        parser.error('ttype must be one of: ' + ', '.join(sorted(RUNNERS)))
+
+    track = PriceTrack.from_store(args.rid, args.days)
+    if len(track.timestamps) < 2:
+        logger.error('Not enough price history for rid %s', args.rid)
+        return
+    logger.info('Replaying %s price points over %s', len(track.timestamps),
+                timeutil.dur_str(track.end() - track.start()))
+
+    grid = {'discount': args.discount, 'interval': args.interval, 'bid': args.bid}
+    if args.ttype == 'flip':
+        grid.update({'maxflips': args.maxflips, 'sellfor': args.sellfor})
+    else:
+        grid['quantity'] = args.quantity
+    results = sweep(track, args.ttype, {'flexbid': True}, grid, args.processes,
+                    spread=args.spread, snipe_loss=args.snipe_loss)
+    sort_key = 'profit' if args.ttype == 'flip' else 'saved_pct'
+    results.sort(key=lambda x: x[1][sort_key] if x[1][sort_key] is not None else -float('inf'), reverse=True)
+    for conf, result in results:
+        logger.info('%s  %s', ', '.join('{}={}'.format(k, conf[k]) for k in sorted(grid)),
+                    ', '.join('{}={}'.format(k, v) for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,25 +2,41 @@
 
 import logging
 import sys
+import threading
 import time
+from collections import Counter
 
-from . import datafile, timeutil, util
+import fut
+
+from . import datafile, governor, timeutil, util
 
 logger = logging.getLogger(__name__)
 
+CLUB_PAGE_SIZE = fut.urls.itemsPerPage['club']
+# tries of a throttled club page
+CLUB_PAGE_ATTEMPTS = 3
+
+# how old the snapshot may be for queries whose result we trade on (see ClubSnapshot.query)
+FRESH_MAX_AGE = 60
+
+# rating ranges of the club levels
+LEVELS = {'gold': (75, 99), 'silver': (65, 74), 'bronze': (0, 64)}
+
 class Club(object):
 
     def __init__(self, fme):
         self.fme = fme
+        self.snapshot = ClubSnapshot(fme)
 
     def all_players(self, level='gold', max_page=10000):
-        return self.club_all_pages(level=level)
+        return self.snapshot.query(level=level)
 
     def special(self, rareflags=[]):
         """Find all special players
         """
-        players = self.club_all_pages(rare=True)
-        return [p for p in players if p['rareflag'] in rareflags] if rareflags else players
+        if rareflags:
+            return self.snapshot.query(rareflags=rareflags)
+        return [p for p in self.snapshot.query() if p['rareflag'] > 1]
 
     def expandables(self):
         '''Returns normal players that are: on transfer list, unassinged, or untradeable
@@ -28,20 +44,19 @@ class Club(object):
         def normal(lst):
             return [x for x in lst if x['rareflag'] in [0, 1]]
 
-        result = [x for x in normal(self.club_all_pages(level='gold')) if x['untradeable']]
+        result = self.snapshot.query(level='gold', rareflags=[0, 1], tradeable=False)
         result += normal(self.fme.tm.tradepile.inactive())
         result += normal(self.fme.session().unassigned())
         return result
 
     def tradeable_totw(self, max_rating=79, min_tenure=30):
         def can_sell(p):
-            tradeable = not p['untradeable']
             games_played = p['statsList'][0]['value']
             tenure = timeutil.dur_days(time.time() - p['timestamp'])
-            return tradeable and p['rating'] <= max_rating and games_played == 0 and tenure >= min_tenure
+            return p['rating'] <= max_rating and games_played == 0 and tenure >= min_tenure
 
-        players = [x for x in self.special(rareflags=[3]) if can_sell(x)]
-        return util.psorted(players)
+        return [x for x in self.snapshot.query(rareflags=[3], tradeable=True, max_age=FRESH_MAX_AGE)
+                if can_sell(x)]
 
     def matchup(self, level=None, nations=None, leagues=None, teams=None):
         players = {}
@@ -68,10 +83,7 @@ class Club(object):
         :return: a list of players
         """
         ids = [x['id'] for x in self.fme.lu.teams.find(teams)]
-        all = []
-        for id in ids:
-            all.extend(self.club_all_pages(level=level, club=id))
-        return all
+        return self.snapshot.query(level=level, teams=ids)
 
     def by_leagues(self, leagues, level=None):
         """Find all club players from specific leagues
@@ -81,10 +93,7 @@ class Club(object):
         :return: a list of players
         """
         ids = [x['id'] for x in self.fme.lu.leagues.find(leagues)]
-        all = []
-        for id in ids:
-            all.extend(self.club_all_pages(level=level, league=id))
-        return all
+        return self.snapshot.query(level=level, leagues=ids)
 
     def by_nations(self, nations, level=None):
         """Find all club players from a specific country
@@ -94,22 +103,219 @@ class Club(object):
         :return: a list of players
         """
         ids = [x['id'] for x in self.fme.lu.nations.find(nations)]
-        all = []
-        for id in ids:
-            all.extend(self.club_all_pages(level=level, nationality=id))
-        return all
+        return self.snapshot.query(level=level, nations=ids)
 
     def club_all_pages(self, max_page=sys.maxsize, **kwargs):
-        players = []
-        page_count = 0
-        while True:
-            page = self.fme.session().club(start=len(players), **kwargs)
-            players.extend(page)
-            page_count += 1
-            if not page or page_count >= max_page:
+        return list(self.club_pages(max_page=max_page, **kwargs))
+
+    def club_pages(self, max_page=sys.maxsize, **kwargs):
+        '''Club players (kwargs are the filters of session().club()), yielded page by page
+
+        Paging stops at the first short page, so a small club takes a single request. The
+        session makes one FUT call at a time anyway (see governor.GovernedSession), so pages
+        are requested one after the other.
+        '''
+        session = self.fme.session()
+        for page in range(max_page):
+            players = self._club_page(session, page, kwargs)
+            for p in players:
+                yield p
+            if len(players) < CLUB_PAGE_SIZE:
                 break
-        return players
 
+    def _club_page(self, session, page, kwargs):
+        # paging the club is housekeeping. rather than give up on the whole club when the
+        # budget stays busy past the deadline, a page waits out the delay and tries again
+        for attempt in range(CLUB_PAGE_ATTEMPTS):
+            try:
+                return session.club(start=page * CLUB_PAGE_SIZE, page_size=CLUB_PAGE_SIZE, **kwargs)
+            except governor.Throttled as e:
+                if attempt == CLUB_PAGE_ATTEMPTS - 1:
+                    raise
+                logger.warning('Club page %s throttled (%s). Waiting for another turn', page, e)
+                time.sleep(e.delay)
 
     def by_rid(self, rid):
+        # one targeted call beats syncing the whole snapshot for a single card
         return [x for x in self.fme.session().club(defId=rid) if x['resourceId'] == rid]
+
+
+class ClubSnapshot(object):
+    '''All club players, kept in ~/.futme/club.bin and queried locally
+
+    The snapshot is synced with the server (every club page, once) when it is older than
+    max_age seconds, and the sync is diff-merged into what is stored. In between, players we
+    send to the club or take out of it are applied locally, and saved at most every
+    save_interval seconds (and by flush()). Queries only touch the network for that sync:
+    they intersect column indexes (league, nation, team, rating, rareflag, tradeable,
+    resourceId) of the players.
+
+    Safe to use from multiple threads.
+    '''
+
+    COLUMNS = {
+        'league': 'leagueId',
+        'nation': 'nation',
+        'team': 'teamid',
+        'rating': 'rating',
+        'rareflag': 'rareflag',
+        'tradeable': lambda p: not p['untradeable'],
+        'rid': 'resourceId'
+    }
+
+    def __init__(self, fme, filename='club.bin', max_age=timeutil.SECONDS_PER_HOUR, save_interval=60):
+        self.fme = fme
+        self.filename = filename
+        self.max_age = max_age
+        self.save_interval = save_interval
+        self.synced_at = None
+        # local updates not saved yet, and when the file was last saved
+        self._dirty = False
+        self._saved_at = 0
+        # syncs, and the players they added, changed and removed
+        self.stats = Counter()
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._players = {}
+        self._index = {column: {} for column in self.COLUMNS}
+
+    def __len__(self):
+        with self._lock:
+            self.sync()
+            return len(self._players)
+
+    def query(self, level=None, leagues=None, nations=None, teams=None, rareflags=None,
+              tradeable=None, rids=None, max_age=None):
+        '''Players matching all the given filters (each a list of accepted values), psorted
+
+        :param level: gold/silver/bronze
+        :param tradeable: True or False
+        :param max_age: (optional) sync first if the snapshot is older than this, instead of
+            the usual max_age. For results we are about to buy or sell on.
+        '''
+        filters = [('league', leagues), ('nation', nations), ('team', teams), ('rareflag', rareflags),
+                   ('rid', rids)]
+        if level is not None:
+            lo, hi = LEVELS[level]
+            filters.append(('rating', range(lo, hi + 1)))
+        if tradeable is not None:
+            filters.append(('tradeable', [tradeable]))
+        with self._lock:
+            self.sync(max_age=max_age)
+            ids = None
+            # smallest candidate set first, so that the intersections stay small
+            for matches in sorted([self._lookup(column, values) for column, values in filters if values is not None],
+                                  key=len):
+                ids = matches if ids is None else ids & matches
+                if not ids:
+                    break
+            players = self._players.values() if ids is None else [self._players[i] for i in ids]
+            return util.psorted([dict(p) for p in players])
+
+    def sync(self, force=False, max_age=None):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            max_age = self.max_age if max_age is None else max_age
+            if force or self.synced_at is None or time.time() - self.synced_at >= max_age:
+                self.merge(self.fme.club.club_all_pages())
+                self.save()
+
+    def merge(self, players):
+        '''Brings the snapshot in line with players, the complete list of club players'''
+        with self._lock:
+            fresh = {p['id']: p for p in players}
+            for item_id in [k for k in self._players if k not in fresh]:
+                self._remove(item_id)
+                self.stats['removed'] += 1
+            for item_id, p in fresh.items():
+                current = self._players.get(item_id)
+                if current is None:
+                    self.stats['added'] += 1
+                elif current != p:
+                    self._remove(item_id)
+                    self.stats['changed'] += 1
+                else:
+                    continue
+                self._add(p)
+            self.stats['syncs'] += 1
+            self.synced_at = time.time()
+
+    # local updates after our own calls
+
+    def added(self, items):
+        '''items were sent to the club. Only players are kept'''
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            players = [x for x in items if x.get('itemType', 'player') == 'player']
+            for x in players:
+                self._remove(x['id'])
+                self._add(dict(x, pile=7))
+            if players:
+                self._changed()
+
+    def removed(self, item_ids):
+        '''items left the club (to the tradepile, quick sold...)'''
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            gone = [item_id for item_id in item_ids if item_id in self._players]
+            for item_id in gone:
+                self._remove(item_id)
+            if gone:
+                self._changed()
+
+    def flush(self):
+        '''Saves the local updates not saved yet'''
+        with self._lock:
+            if self._dirty:
+                self.save()
+
+    def save(self):
+        with self._lock:
+            datafile.save_json({'synced_at': self.synced_at, 'players': list(self._players.values())},
+                               self.filename)
+            self._dirty = False
+            self._saved_at = time.time()
+
+    def _changed(self):
+        # the whole file is rewritten on save. bursts of buys and sells share one
+        self._dirty = True
+        if time.time() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def _load(self):
+        self._loaded = True
+        # missing or corrupt: the next sync rebuilds it
+        data = datafile.load_cache(self.filename)
+        if not isinstance(data, dict):
+            return
+        for p in data.get('players', []):
+            self._add(p)
+        self.synced_at = data.get('synced_at')
+
+    def _lookup(self, column, values):
+        index = self._index[column]
+        ids = set()
+        for v in values:
+            ids.update(index.get(v, ()))
+        return ids
+
+    def _add(self, p):
+        p = dict(p)
+        self._players[p['id']] = p
+        for column, key in self.COLUMNS.items():
+            v = key(p) if callable(key) else p[key]
+            self._index[column].setdefault(v, set()).add(p['id'])
+
+    def _remove(self, item_id):
+        p = self._players.pop(item_id, None)
+        if p is None:
+            return
+        for column, key in self.COLUMNS.items():
+            v = key(p) if callable(key) else p[key]
+            ids = self._index[column][v]
+            ids.discard(item_id)
+            if not ids:
+                del self._index[column][v]
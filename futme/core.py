@@ -11,6 +11,7 @@ import requests
 from . import datafile
 from .club import Club
 from .display import Display
+from .governor import GovernedSession, Governor
 from .lookup import Lookups
 from .process import Proc
 from .transfer import TransferMarket
@@ -19,28 +20,45 @@ logger = logging.getLogger(__name__)
 
 class Futme(object):
 
-    def __init__(self):
+    def __init__(self, session=None, lookups=None, governor=None):
+        '''
+        :param session: (optional) a logged in fut.Core, or a stand-in such as benchmarks.sim.SimCore.
+            Logs in on first use if not given.
+        :param lookups: (optional) Lookups to use instead of the ones cached in ~/.futme.
+        :param governor: (optional) the Governor that rate limits all session calls.
+            Configured from ~/.futme/governor.json if not given.
+        '''
         self.db_dir = os.path.expanduser('~/.futme')
-        self.lu = Lookups(self.db_dir)
+        self.lu = lookups if lookups is not None else Lookups(self.db_dir)
         self.tm = TransferMarket(self)
         self.disp = Display(self)
         self.proc = Proc(self)
         self.club = Club(self)
+        self.governor = governor if governor is not None else Governor.from_conf()
         self._session = None
+        self._governed_session = None
+        if session is not None:
+            self._set_session(session)
         logger.info('Ready to FUTME!')
 
     def session(self):
         if self._session is None:
             self.login()
-        return self._session
+        return self._governed_session
+
+    def _set_session(self, session):
+        self._session = session
+        # everyone shares the session (and its rate limits) through the governor
+        self._governed_session = GovernedSession(session, self.governor)
 
     def login(self):
         logger.info('Logging in to FUT...')
         creds = datafile.load_json('credentials.json')
-        self._session = fut.Core(creds['email'], creds['password'], creds['secret'], platform='ps4', sms=True)
+        self._set_session(fut.Core(creds['email'], creds['password'], creds['secret'], platform='ps4', sms=True))
         logger.info('Logged in')
-        return self._session
+        return self._governed_session
 
     def shutdown(self):
+        self.club.snapshot.flush()
         if self._session is not None:
             self._session.logout()
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import codecs
+import contextlib
+import gzip
 import json
 import logging
+import mmap
 import os
+import pickle
+import struct
+import time
+import zlib
 
 import unicodecsv as csv
 
@@ -11,49 +17,174 @@ logger = logging.getLogger(__name__)
 
 DB_DIR = os.path.expanduser('~/.futme')
 
+# save_json and load_json pick the format by extension: .bin files are a pickle of the data
+# behind a checksummed header (for caches only futme reads), anything else is json
+BIN_EXT = '.bin'
+_BIN_MAGIC = b'FMDF'
+_BIN_VERSION = 1
+_BIN_HEADER = struct.Struct('=4sHII')  # magic, version, crc32 and length of the pickle
+# .bin files at least this big are read through mmap instead of into a buffer first
+MMAP_MIN_SIZE = 1 << 20
+
+# the columns of dump_players tsv files (see Display.to_list), and the numeric ones that
+# also go to the npz file
+DUMP_COLUMNS = ['iid', 'aid', 'rid', 'name', 'pos', 'rat', 'rf', 'tr', 'club', 'league', 'nation', 'dv', 'ls']
+NUMERIC_DUMP_COLUMNS = ['iid', 'aid', 'rid', 'rat', 'dv', 'ls']
+# stands in for None (e.g. no lastSalePrice) in the npz file. ids and prices are never negative
+NUMERIC_DUMP_MISSING = -1
+
 def last_modified(filename):
     filepath = dbfilepath(filename)
     return os.path.getmtime(filepath)
 
+class CorruptFile(ValueError):
+    pass
+
 def load_json(filename):
-    data = []
-    filepath = dbfilepath(filename)
+    '''The data in filename, or [] if it cannot be read (the error is logged)'''
     try:
-        with codecs.open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        return _read(filename)
     except Exception as e:
         logger.error('Error loading json from %s: %s', filename, e)
-    return data
+    return []
 
-def save_json(data, filename):
-    filepath = dbfilepath(filename)
+def load_cache(filename):
+    '''The data in filename, or None if it is missing or corrupt and needs to be rebuilt'''
+    if not os.path.exists(dbfilepath(filename)):
+        return None
     try:
-        with codecs.open(filepath, 'wb', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, sort_keys=True)
+        return _read(filename)
+    except Exception as e:
+        logger.warning('Cache %s is unreadable, rebuilding it: %s', filename, e)
+    return None
+
+def save_json(data, filename, indent=4):
+    '''Saves data to filename, as json or .bin
+
+    Json is indented and key-sorted, so that conf files stay as editable as they were.
+    indent=None writes it compact, for big files nobody edits by hand.
+
+    Written to a temp file and renamed into place, so a crash never leaves a partial file.
+    '''
+    try:
+        if filename.endswith(BIN_EXT):
+            payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            with atomic_open(filename, 'wb') as f:
+                f.write(_BIN_HEADER.pack(_BIN_MAGIC, _BIN_VERSION, zlib.crc32(payload), len(payload)))
+                f.write(payload)
+        else:
+            # dumps, not dump: dump encodes in python, chunk by chunk
+            text = json.dumps(data, ensure_ascii=False, indent=indent, sort_keys=indent is not None,
+                              separators=None if indent is not None else (',', ':'))
+            with atomic_open(filename, 'w', encoding='utf-8') as f:
+                f.write(text)
     except Exception as e:
         logger.error('Error saving json to %s: %s', filename, e)
 
-def save_tsv(rows, filename):
+def _read(filename):
     filepath = dbfilepath(filename)
+    with open(filepath, 'rb') as f:
+        if not filename.endswith(BIN_EXT):
+            return json.loads(f.read().decode('utf-8'))
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+            return _decode_bin(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+            return _decode_bin(buf)
+
+def _decode_bin(buf):
+    if len(buf) < _BIN_HEADER.size:
+        raise CorruptFile('truncated header')
+    magic, version, crc, length = _BIN_HEADER.unpack_from(buf, 0)
+    if magic != _BIN_MAGIC or version != _BIN_VERSION:
+        raise CorruptFile('not a version {} data file'.format(_BIN_VERSION))
+    payload = memoryview(buf)[_BIN_HEADER.size:]
+    try:
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise CorruptFile('checksum mismatch')
+        return pickle.loads(payload)
+    finally:
+        payload.release()
+
+def save_tsv(rows, filename):
     try:
-        with open(filepath, 'wb') as f:
+        with atomic_open(filename, 'wb') as f:
             tsv_writer = csv.writer(f, delimiter='\t', encoding='utf-8')
             for row in rows:
                 tsv_writer.writerow(row)
     except Exception as e:
         logger.error('Error saving data to %s: %s', filename, e)
 
-def dump_players(players, dump_name, fme):
-    jsonfile = dump_name + '.json'
-    save_json(players, jsonfile)
+@contextlib.contextmanager
+def atomic_open(filename, mode='w', opener=open, **kwargs):
+    '''Opens a temp file next to filename, and renames it to filename once the block is done
+
+    Readers see either the old file or the complete new one, never a partial one. If the
+    block raises, the temp file is removed and filename is left alone.
+    '''
+    filepath = dbfilepath(filename)
+    tmp_path = '{}.{}.tmp'.format(filepath, os.getpid())
+    try:
+        with opener(tmp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def dump_players(players, dump_name, fme, compress=False, columnar=False):
+    '''Writes players to dump_name.ndjson (one json object per line) and dump_name.tsv
+
+    players can be any iterable (e.g. Club.club_pages()): the rows are written as they come,
+    without holding them all in memory.
 
+    :param compress: write dump_name.ndjson.gz instead of dump_name.ndjson.
+    :param columnar: also write the NUMERIC_DUMP_COLUMNS to dump_name.npz, as int64 numpy
+        arrays with NUMERIC_DUMP_MISSING for None. Failing that does not fail the rest.
+    '''
+    jsonfile = dump_name + ('.ndjson.gz' if compress else '.ndjson')
     tsvfile = dump_name + '.tsv'
-    rows = [['iid', 'aid', 'rid', 'name', 'pos', 'rat', 'rf', 'tr', 'club', 'league', 'nation', 'dv', 'ls']]
-    for p in players:
-        rows.append(fme.disp.to_list(p))
-    save_tsv(rows, tsvfile)
+    numeric = [DUMP_COLUMNS.index(c) for c in NUMERIC_DUMP_COLUMNS]
+    columns = [[] for _ in numeric]
+    start = time.time()
+    count = 0
+    try:
+        with contextlib.ExitStack() as stack:
+            if compress:
+                json_f = stack.enter_context(atomic_open(jsonfile, 'wt', gzip.open, encoding='utf-8'))
+            else:
+                json_f = stack.enter_context(atomic_open(jsonfile, 'w', encoding='utf-8'))
+            tsv_writer = csv.writer(stack.enter_context(atomic_open(tsvfile, 'wb')), delimiter='\t', encoding='utf-8')
+            tsv_writer.writerow(DUMP_COLUMNS)
+            for p in players:
+                json_f.write(json.dumps(p, ensure_ascii=False, separators=(',', ':')))
+                json_f.write('\n')
+                row = fme.disp.to_list(p)
+                tsv_writer.writerow(row)
+                if columnar:
+                    for values, i in zip(columns, numeric):
+                        values.append(row[i])
+                count += 1
+    except Exception as e:
+        logger.error('Error saving dump %s: %s', dump_name, e)
+        return
 
-    logger.info('Saved %s players to dump %s', len(players), dump_name)
+    elapsed = time.time() - start
+    logger.info('Saved %s players to dump %s in %.1fs (%.0f rows/s)',
+                count, dump_name, elapsed, count / elapsed if elapsed > 0 else 0)
+    if columnar:
+        _save_npz(columns, dump_name + '.npz')
+
+def _save_npz(columns, filename):
+    try:
+        # numpy only loads when it is needed, it is slow to import
+        import numpy as np
+        arrays = {c: np.array([NUMERIC_DUMP_MISSING if x is None else x for x in v], dtype=np.int64)
+                  for c, v in zip(NUMERIC_DUMP_COLUMNS, columns)}
+        with atomic_open(filename, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+    except Exception as e:
+        logger.error('Error saving %s: %s', filename, e)
 
 
 def dbfilepath(filename):
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -10,12 +11,23 @@ class Display(object):
 
     def __init__(self, fme):
         self.fme = fme
+        # derived strings: names by assetId, and lookup abbrs by lookup and id
+        self._names = {}
+        self._abbrs = {}
+        self._lock = threading.Lock()
 
     def name_str(self, c, max_len=20):
         if c['itemType'] == 'player':
-            pp = self.fme.lu.players[c['assetId']]
-            name = pp['surname'] if pp['surname'] is not None else pp['lastname'] + ', ' + pp['firstname']
-            return name if len(name) <= max_len else name[:max_len-3] + '...'
+            key = (c['assetId'], max_len)
+            with self._lock:
+                name = self._names.get(key)
+            if name is None:
+                pp = self.fme.lu.players[c['assetId']]
+                name = pp['surname'] if pp['surname'] is not None else pp['lastname'] + ', ' + pp['firstname']
+                name = name if len(name) <= max_len else name[:max_len-3] + '...'
+                with self._lock:
+                    self._names[key] = name
+            return name
         else:
             return u'{} {}'.format(c['itemType'], c['cardType'])
 
@@ -24,18 +36,28 @@ class Display(object):
         return RARE_FLAGS.get(rf, 'rf' + str(rf))
 
     def team_str(self, id):
-        return none_str(self.fme.lu.teams.to_abbr(id))
+        return self._abbr(self.fme.lu.teams, id)
 
     def league_str(self, id):
-        return none_str(self.fme.lu.leagues.to_abbr(id))
+        return self._abbr(self.fme.lu.leagues, id)
 
     def nation_str(self, id):
-        return none_str(self.fme.lu.nations.to_abbr(id))
+        return self._abbr(self.fme.lu.nations, id)
+
+    def _abbr(self, store, id):
+        # memoized per items of the store: a reload of the lookups starts over
+        with self._lock:
+            items, abbrs = self._abbrs.get(store.name, (None, None))
+            if items is not store.items:
+                items, abbrs = store.items, {}
+                self._abbrs[store.name] = (items, abbrs)
+            abbr = abbrs.get(id)
+            if abbr is None:
+                abbr = abbrs[id] = none_str(store.to_abbr(id))
+            return abbr
 
     def print_list(self, cards, logger=None):
-        sfmt = self.fme.disp.format(cards)
-        for c in cards:
-            s = self.fme.disp.sprint(sfmt, c)
+        for s in self.format(cards).table(cards):
             if logger is None:
                 print(s)
             else:
@@ -43,16 +65,10 @@ class Display(object):
 
 
     def sprint(self, fmt, card, *data):
-        ext = {
-            'name':   self.name_str(card),
-            'pos':    none_str(card['position']),
-            'team':   self.team_str(card['teamid']),
-            'league': self.league_str(card['leagueId']),
-            'nation': self.nation_str(card['nation']),
-            'rf':     self.rareflag_str(card),
-            'ut':     'UT' if card['untradeable'] else 'T'
-        }
-        return fmt.format(p=card, e=ext, *data)
+        '''One row of fmt (a RowFormatter from format()) for card, with data for the prepend
+        and append fields
+        '''
+        return fmt.row(card, *data)
 
     def to_list(self, card):
         return [
@@ -71,37 +87,76 @@ class Display(object):
             card['lastSalePrice'],
         ]
 
+    def derived_strs(self, card):
+        '''The strings of card that come from lookups: name, pos, rf, ut, team, league, nation'''
+        return (self.name_str(card), none_str(card['position']), self.rareflag_str(card),
+                'UT' if card['untradeable'] else 'T', self.team_str(card['teamid']),
+                self.league_str(card['leagueId']), self.nation_str(card['nation']))
+
     def format(self, items, prepend='', append=''):
-        pw = col_widths(items)
-        ew = {
-            'name':   max([len(self.name_str(x)) for x in items]),
-            'team':   max([len(self.team_str(x['teamid'])) for x in items]),
-            'league': max([len(self.league_str(x['leagueId'])) for x in items]),
-            'nation': max([len(self.nation_str(x['nation'])) for x in items]),
-            'rf':     4,
-            'ut':     2,
-            'pos':    3
-        }
-        p = lambda k: '{p['+k+']:<'+str(pw[k])+'}'
-        e = lambda k: '{e['+k+']:<'+str(ew[k])+'}'
-        result = u'{}|{}|{}  {}  {} {}  {} {}  {}|{}|{}  dv={} ls={}'.format(
-            p('id'), p('assetId'), p('resourceId'),
-            e('name'), e('pos'), p('rating'), e('rf'), e('ut'),
-            e('team'), e('league'), e('nation'),
-            p('discardValue'), p('lastSalePrice'))
-        if prepend: result = prepend + '  ' + result
-        if append: result = result + '  ' + append
-        return result
-
-
-def col_widths(cards):
-    wmap = {}
-    for c in cards:
-        for prop in c:
-            w = len(none_str(c[prop]))
-            if prop not in wmap or w > wmap[prop]:
-                wmap[prop] = w
-    return wmap
+        '''A RowFormatter for items, with columns as wide as the widest value in items
+
+        Not a format string: pass it to sprint(), or call its row() and table().
+        '''
+        return RowFormatter(self, items, prepend, append)
+
+
+class RowFormatter(object):
+    '''The row format of a list of cards, compiled once
+
+    The derived strings of each card (see Display.derived_strs) are resolved once, and the
+    widths are only computed for the printed columns. prepend and append are format strings
+    of extra fields, filled with the data passed to row().
+
+    fmt = disp.format(cards, append='mp={}')
+    fmt.row(card, 1000), or fmt.table(cards, [(1000,), (1100,)...])
+    '''
+
+    # printed columns: card props, and derived strings (the index into derived_strs)
+    _COLUMNS = [('id', None), ('assetId', None), ('resourceId', None), ('name', 0), ('pos', 1),
+                ('rating', None), ('rf', 2), ('ut', 3), ('team', 4), ('league', 5), ('nation', 6),
+                ('discardValue', None), ('lastSalePrice', None)]
+    _LAYOUT = u'{}|{}|{}  {}  {} {}  {} {}  {}|{}|{}  dv={} ls={}'
+    # derived columns printed at a fixed width
+    _FIXED_WIDTHS = {'rf': 4, 'ut': 2, 'pos': 3}
+
+    def __init__(self, disp, items, prepend='', append=''):
+        self.disp = disp
+        # derived strings by id(card). the card is kept along, so that its id stays its own
+        self._derived = {id(c): (c, disp.derived_strs(c)) for c in items}
+        widths = []
+        for name, i in RowFormatter._COLUMNS:
+            if name in RowFormatter._FIXED_WIDTHS:
+                widths.append(RowFormatter._FIXED_WIDTHS[name])
+            elif i is None:
+                widths.append(max([len(none_str(v)) for v in {c[name] for c in items}] or [0]))
+            else:
+                widths.append(max([len(v) for v in {d[i] for _, d in self._derived.values()}] or [0]))
+        fields = ['{{r[{}]:<{}}}'.format(n, w) for n, w in enumerate(widths)]
+        template = RowFormatter._LAYOUT.format(*fields)
+        if prepend: template = prepend + '  ' + template
+        if append: template = template + '  ' + append
+        self.template = template
+
+    def __str__(self):
+        return self.template
+
+    def row(self, card, *data):
+        return self.template.format(*data, r=self._values(card))
+
+    def table(self, cards, data=None):
+        '''All the rows of cards, with data[i] (a tuple) for the extra fields of row i'''
+        fmt = self.template.format
+        if data is None:
+            return [fmt(r=self._values(c)) for c in cards]
+        return [fmt(*d, r=self._values(c)) for c, d in zip(cards, data)]
+
+    def _values(self, card):
+        cached = self._derived.get(id(card))
+        d = cached[1] if cached is not None and cached[0] is card else self.disp.derived_strs(card)
+        return (card['id'], card['assetId'], card['resourceId'], d[0], d[1], card['rating'],
+                d[2], d[3], d[4], d[5], d[6], card['discardValue'], card['lastSalePrice'])
+
 
 def max_width(lst):
     return max([len(none_str(x)) for x in lst]) if lst else 0
@@ -3,10 +3,9 @@
 import json
 import logging
 
-import requests
 from bs4 import BeautifulSoup
 
-from . import util
+from . import httpclient, util
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +26,7 @@ def sbc_buyer_config(fme, fbid, quantity):
     if pdef is None:
         notes = 'Invalid rid for fbid={}'.format(fbid)
     else:
-        extra = [x for x in fme.tm.tradepile.inactive() if x['resourceId'] == rid]
+        extra = fme.tm.tradepile.by_rid(rid, [None])
         owned = fme.club.by_rid(rid) + extra
         name = fme.disp.name_str(pdef)
         pos = pdef['position']
@@ -53,6 +52,6 @@ def sbc_buyer_config(fme, fbid, quantity):
 
 def player_resource_id(futbin_id):
     url = 'https://www.futbin.com/19/player/{}'.format(futbin_id)
-    html = requests.get(url).text
+    html = httpclient.get(url).text
     soup = BeautifulSoup(html, 'html.parser')
     return int(soup.find(id='page-info').get('data-player-resource'))
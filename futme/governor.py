@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+import fut
+
+from . import datafile, metrics
+
+logger = logging.getLogger(__name__)
+
+# priority classes. lower goes first
+BID = 0
+DISCOVERY = 1
+HOUSEKEEPING = 2
+PRIORITY_NAMES = {BID: 'bid', DISCOVERY: 'discovery', HOUSEKEEPING: 'housekeeping'}
+
+# session method -> endpoint budget it draws from. anything else draws from 'default'
+ENDPOINTS = {
+    'search': 'search',
+    'searchDefinition': 'search',
+    'bid': 'bid',
+    'club': 'club',
+    'clubConsumables': 'club',
+    'sendToClub': 'club',
+    'quickSell': 'club',
+    'tradepile': 'tradepile',
+    'tradepileClear': 'tradepile',
+    'relist': 'tradepile',
+    'sell': 'tradepile',
+    'sendToTradepile': 'tradepile'
+}
+
+# priority of a call unless the caller says otherwise (see Governor.priority)
+DEFAULT_PRIORITIES = {'bid': BID, 'search': DISCOVERY}
+
+# endpoint -> (calls per minute, burst). 'total' is shared by all endpoints
+BUDGETS = {
+    'total': (40, 10),
+    'search': (20, 5),
+    'bid': (20, 5),
+    'club': (10, 5),
+    'tradepile': (10, 5),
+    'default': (20, 5)
+}
+
+# priority -> seconds a call may wait for its budget before it is dropped
+DEADLINES = {BID: 10, DISCOVERY: 30, HOUSEKEEPING: 120}
+
+# FutError codes EA answers with when we call too often
+SOFT_BAN_CODES = (426, 429, 458, 512, 521)
+
+_CONF_FILE = 'governor.json'
+
+class Throttled(Exception):
+    '''A call was dropped because its budget did not allow it before its deadline
+
+    delay is the seconds the call would have had to wait
+    '''
+
+    def __init__(self, msg, delay=0):
+        super(Throttled, self).__init__(msg)
+        self.delay = delay
+
+
+class TokenBucket(object):
+
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_to_token(self):
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class Governor(object):
+    '''Rate limits the calls all futme components make to the FUT session
+
+    Every call takes a token from its endpoint's bucket and from the shared 'total' bucket.
+    Calls that have to wait queue up, and whenever tokens are available they go to the
+    waiting call with the best priority (then the longest waiting). A call still waiting
+    at its deadline raises Throttled instead. A soft ban response (e.g. 429) empties all
+    buckets and stops all calls for cooldown seconds.
+
+    governor = Governor()
+    session = GovernedSession(fut_core, governor)
+    with governor.priority(BID):
+        session.search('player', defId=rid, max_buy=1000)  # queued as a bid
+    '''
+
+    def __init__(self, budgets=BUDGETS, deadlines=DEADLINES, cooldown=60):
+        self.buckets = {k: TokenBucket(*v) for k, v in budgets.items()}
+        self.deadlines = deadlines
+        self.cooldown = cooldown
+        self.cooldown_until = 0
+        self.stats = {x: Counter() for x in ['calls', 'waited', 'wait_ms', 'throttled', 'soft_bans']}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._local = threading.local()
+
+    @classmethod
+    def from_conf(cls):
+        '''A Governor with the budgets, deadlines and cooldown in governor.json, if there is one
+
+        {"budgets": {"search": [30, 5]}, "deadlines": {"bid": 5}, "cooldown": 120}
+        '''
+        conf = {}
+        if os.path.exists(datafile.dbfilepath(_CONF_FILE)):
+            conf = datafile.load_json(_CONF_FILE)
+        budgets = dict(BUDGETS)
+        budgets.update({k: tuple(v) for k, v in conf.get('budgets', {}).items()})
+        deadlines = dict(DEADLINES)
+        names = {v: k for k, v in PRIORITY_NAMES.items()}
+        for k, v in conf.get('deadlines', {}).items():
+            if k in names:
+                deadlines[names[k]] = v
+            else:
+                logger.error('Unknown priority %r in the deadlines of %s (one of: %s). Ignored',
+                             k, _CONF_FILE, ', '.join(sorted(names)))
+        return cls(budgets, deadlines, conf.get('cooldown', 60))
+
+    @contextlib.contextmanager
+    def priority(self, priority):
+        '''Calls made by this thread in the with block are queued with the given priority'''
+        prev = getattr(self._local, 'priority', None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = prev
+
+    def acquire(self, endpoint):
+        '''Waits until endpoint's budget allows a call
+
+        :return: the seconds waited
+        :raises Throttled: if the call's deadline passes first
+        '''
+        priority = getattr(self._local, 'priority', None)
+        if priority is None:
+            priority = DEFAULT_PRIORITIES.get(endpoint, HOUSEKEEPING)
+        start = time.time()
+        deadline = start + self.deadlines[priority]
+        ticket = (priority, next(self._seq), endpoint)
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    now = time.time()
+                    delay = self._delay(ticket, now)
+                    if delay == 0:
+                        self._take(endpoint)
+                        break
+                    if now + delay > deadline:
+                        self.stats['throttled'][endpoint] += 1
+                        raise Throttled('{} call ({}) would wait {:.0f}s, over its {}s deadline'.format(
+                            endpoint, PRIORITY_NAMES[priority], delay, self.deadlines[priority]), delay)
+                    self._cond.wait(delay)
+            finally:
+                self._waiting.remove(ticket)
+                # let the next in line see if it can go now
+                self._cond.notify_all()
+        waited = time.time() - start
+        self.stats['calls'][endpoint] += 1
+        if waited > 0.001:
+            self.stats['waited'][endpoint] += 1
+            self.stats['wait_ms'][endpoint] += int(waited * 1000)
+        return waited
+
+    def _delay(self, ticket, now):
+        '''Seconds (at least) until ticket may go. 0 if it may go now'''
+        if now < self.cooldown_until:
+            return self.cooldown_until - now
+        for b in self.buckets.values():
+            b.refill(now)
+        _, _, endpoint = ticket
+        delay = max([b.time_to_token() for b in self._buckets(endpoint)] + [0])
+        if delay > 0:
+            return delay
+        # the budget allows it. a waiting call of better priority gets it first, unless
+        # that call is held up by its own endpoint's budget anyway. it notifies when done
+        first = min(x for x in self._waiting if self._has_token(x[2]))
+        return 0 if first == ticket else 0.1
+
+    def _take(self, endpoint):
+        for b in self._buckets(endpoint):
+            b.tokens -= 1
+
+    def _buckets(self, endpoint):
+        return [b for b in [self.buckets.get(endpoint), self.buckets.get('total')] if b is not None]
+
+    def _has_token(self, endpoint):
+        b = self.buckets.get(endpoint)
+        return b is None or b.tokens >= 1
+
+    def soft_ban(self, endpoint, error):
+        '''Backs off all calls for cooldown seconds after EA told us we are calling too often'''
+        with self._cond:
+            self.stats['soft_bans'][endpoint] += 1
+            now = time.time()
+            if self.cooldown > 0 and now >= self.cooldown_until:
+                logger.warning('FUT %s call refused (%r). Holding all calls for %ss', endpoint, error, self.cooldown)
+            self.cooldown_until = max(self.cooldown_until, now + self.cooldown)
+            for b in self.buckets.values():
+                b.tokens = 0
+
+    def stats_str(self):
+        return ', '.join('{}={}'.format(k, sum(v.values())) for k, v in self.stats.items())
+
+
+class GovernedSession(object):
+    '''Wraps a fut.Core (or anything with its interface) so that every call goes through a Governor
+
+    Attributes that are not methods (e.g. duplicates) are passed through as they are.
+
+    A fut.Core is not thread-safe (one requests session, one token), so calls from different
+    threads (async traders, club page fetchers...) are made one at a time. The wait for the
+    budget happens before, without holding up the others.
+    '''
+
+    def __init__(self, session, governor):
+        self._session = session
+        self._governor = governor
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._session, name)
+        if not callable(attr):
+            return attr
+        endpoint = ENDPOINTS.get(name, 'default')
+        governor = self._governor
+        lock = self._lock
+
+        def call(*args, **kwargs):
+            governor.acquire(endpoint)
+            try:
+                # only the call itself is timed. the wait for the budget is in governor.stats
+                with lock, metrics.registry.timed('fut', name):
+                    return attr(*args, **kwargs)
+            except fut.exceptions.FutError as e:
+                if getattr(e, 'code', None) in SOFT_BAN_CODES:
+                    governor.soft_ban(endpoint, e)
+                raise
+        return call
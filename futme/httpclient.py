@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# responses worth another try. anything else is returned to the caller as it is
+RETRY_STATUSES = (429, 500, 502, 503, 504, 520, 521, 522, 524)
+
+class HttpClient(object):
+    '''HTTP client for futbin, futhead and the EA lookup files
+
+    Connections are kept alive and reused (up to pool_size per host). Every request has a
+    timeout, and connection errors, timeouts and RETRY_STATUSES responses are retried up to
+    retries times, sleeping a random time up to backoff * 2^attempt (capped at max_backoff)
+    in between. Each attempt is recorded in metrics (kind 'http').
+    '''
+
+    def __init__(self, pool_size=10, timeout=(5, 30), retries=3, backoff=0.5, max_backoff=8):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = metrics.url_endpoint(url, method)
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                with metrics.registry.timed('http', endpoint):
+                    r = self.session.request(method, url, **kwargs)
+                    metrics.registry.add_bytes('http', endpoint, len(r.content))
+                    if r.status_code in RETRY_STATUSES and not last_attempt:
+                        # counted as an error, same as a connection error
+                        r.raise_for_status()
+                return r
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.HTTPError) as e:
+                if last_attempt:
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logger.debug('%s %s failed (%s). Retrying in %.1fs', method, url, e, delay)
+                time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        '''GET url and parse the response as json
+
+        :raises requests.exceptions.RequestException: if the request failed, or the status is not 2xx
+        :raises ValueError: if the response is not json
+        '''
+        r = self.get(url, **kwargs)
+        r.raise_for_status()
+        return r.json()
+
+
+client = HttpClient()
+
+def get(url, **kwargs):
+    return client.get(url, **kwargs)
+
+def head(url, **kwargs):
+    return client.head(url, **kwargs)
+
+def get_json(url, **kwargs):
+    return client.get_json(url, **kwargs)
@@ -6,23 +6,28 @@ import json
 import logging
 import os
 import sys
+import threading
+import time
+import unicodedata
 
 import fut
 import requests
 
-from . import datafile
+from . import datafile, httpclient, timeutil
+from .snapshot import PlayerSnapshot
 
 logger = logging.getLogger(__name__)
 
 class Lookups(object):
 
     _RAW_DATA_URL = 'https://www.easports.com/fifa/ultimate-team/web-app/loc/en_US.json'
+    _PLAYERS_URL = fut.urls.card_info_url + 'players.json'
 
     _LU_FILE_META    = 'futme_lu_meta.json'
-    _LU_FILE_NATIONS = 'futme_lu_nations.json'
-    _LU_FILE_LEAGUES = 'futme_lu_leagues.json'
-    _LU_FILE_TEAMS   = 'futme_lu_teams.json'
-    _LU_FILE_PLAYERS = 'futme_lu_players.json'
+    _LU_FILE_NATIONS = 'futme_lu_nations.bin'
+    _LU_FILE_LEAGUES = 'futme_lu_leagues.bin'
+    _LU_FILE_TEAMS   = 'futme_lu_teams.bin'
+    _LU_FILE_PLAYERS = 'futme_lu_players.snap'
 
     _RAW_KEY_PREFIXES_NATION = {'name':  'search.nationName.nation',
                                 'abbr':  'search.nationAbbr12.nation'}
@@ -33,48 +38,170 @@ class Lookups(object):
                                 'abbr':  'global.teamabbr3.2019.team',
                                 'abbr2': 'global.teamabbr10.2019.team'}
 
-    def __init__(self, db_dir = '.', force_reload = False):
+    # how long the cached lookups are trusted before upstream is checked for changes again
+    _MAX_AGE = 12 * timeutil.SECONDS_PER_HOUR
+
+    _meta_lock = threading.Lock()
+
+    def __init__(self, db_dir = '.', force_reload = False, max_age = _MAX_AGE):
         self.db_dir = os.path.abspath(db_dir)
+        self.max_age = max_age
         self.nations = LookupStore('nation')
         self.leagues = LookupStore('league')
         self.teams = LookupStore('team')
-        self.players = self._load_players()
+        self._players = None
+        self._player_index = None
         self._init_data(force_reload)
-        logger.info('%s nations, %s leagues, %s teams, %s players',
-            len(self.nations.items), len(self.leagues.items),
-            len(self.teams.items), len(self.players))
+        logger.info('%s nations, %s leagues, %s teams',
+            len(self.nations.items), len(self.leagues.items), len(self.teams.items))
+
+    @property
+    def players(self):
+        '''Player definitions keyed by assetId. Loaded on first access
+
+        The definitions are the records of fut.core.players(): id, firstname, lastname,
+        surname (None if the player has none) and rating.
+        '''
+        if self._players is None:
+            self._players = self._load_players()
+            logger.info('%s players', len(self._players))
+        return self._players
+
+    def find_players(self, val):
+        '''Find player definitions by partial name (case and accent insensitive)
+
+        :return: matching players, highest rated first
+        '''
+        if self._player_index is None:
+            self._player_index = NameIndex(_player_names(self.players))
+        return sorted(self._player_index.search(val), key=lambda x: x['rating'], reverse=True)
 
     def _load_players(self):
+        # the snapshot is only rebuilt when the upstream players.json has changed
+        meta = datafile.load_json(Lookups._LU_FILE_META)
+        snapshot_file = datafile.dbfilepath(Lookups._LU_FILE_PLAYERS)
+        meta = meta if isinstance(meta, dict) else {}
+        last_modified = meta.get('playersLastModified') if os.path.isfile(snapshot_file) else None
+        if last_modified and not self._expired(meta.get('playersLastChecked')):
+            try:
+                return PlayerSnapshot(snapshot_file)
+            except Exception as e:
+                logger.error('Error loading player snapshot %s: %s', snapshot_file, e)
+                last_modified = None
+
+        headers = {'If-Modified-Since': last_modified} if last_modified else {}
+        try:
+            r = httpclient.head(Lookups._PLAYERS_URL, headers = headers)
+            modified = r.status_code != 304
+            upstream_modified = r.headers.get('Last-Modified')
+            checked = True
+        except requests.exceptions.RequestException as e:
+            logger.warning('Failed to check %s for update: %s', Lookups._PLAYERS_URL, e)
+            modified = last_modified is None
+            upstream_modified = None
+            checked = False
+
+        if not modified:
+            try:
+                snapshot = PlayerSnapshot(snapshot_file)
+                if checked:
+                    self._save_meta(playersLastChecked=time.time())
+                return snapshot
+            except Exception as e:
+                logger.error('Error loading player snapshot %s: %s', snapshot_file, e)
+
+        players = self._fetch_players()
+        PlayerSnapshot.write(snapshot_file, players)
+        self._save_meta(playersLastModified=upstream_modified, playersLastChecked=time.time())
+        logger.info('Players loaded from source')
+        return PlayerSnapshot(snapshot_file)
+
+    def _fetch_players(self):
+        # the same as fut.core.players(), but through httpclient (retries, metrics)
+        data = httpclient.get_json(Lookups._PLAYERS_URL)
         players = {}
-        for id, player in fut.core.players().items():
-            players[id] = player
-        datafile.save_json(list(players.values()), Lookups._LU_FILE_PLAYERS)
+        for i in data['Players'] + data['LegendsPlayers']:
+            players[i['id']] = {'id': i['id'],
+                                'firstname': i['f'],
+                                'lastname': i['l'],
+                                'surname': i.get('c'),
+                                'rating': i['r']}
         return players
 
+    def _save_meta(self, **kwargs):
+        # the main thread (players) and the _revalidate thread (lookups) both update the
+        # meta file. without the lock one of them can write back a stale copy
+        with Lookups._meta_lock:
+            meta = datafile.load_json(Lookups._LU_FILE_META)
+            meta = meta if isinstance(meta, dict) else {}
+            meta.update(kwargs)
+            datafile.save_json(meta, Lookups._LU_FILE_META)
+
     def _init_data(self, force_reload):
         logger.info('Initializing (db_dir is %s)', self.db_dir)
         if not os.path.isdir(self.db_dir):
             os.mkdir(self.db_dir)
 
         meta = datafile.load_json(Lookups._LU_FILE_META)
-        if force_reload or 'lastModified' not in meta or self._modified_since(meta['lastModified']):
-            self._reload()
-            logger.info('Lookup loaded from source')
-        else:
-            self.nations.items = datafile.load_json(Lookups._LU_FILE_NATIONS)
-            self.leagues.items = datafile.load_json(Lookups._LU_FILE_LEAGUES)
-            self.teams.items   = datafile.load_json(Lookups._LU_FILE_TEAMS)
-            logger.info('Lookup loaded from cache')
+        meta = meta if isinstance(meta, dict) else {}
+        if force_reload or 'lastModified' not in meta or not self._load_cache():
+            try:
+                self._reload()
+                logger.info('Lookup loaded from source')
+            except requests.exceptions.RequestException as e:
+                # a stale cache beats no lookups at all. without either there is no point going on
+                if not self._load_cache():
+                    raise
+                logger.error('Failed to load lookups from %s, using the cached ones: %s',
+                             Lookups._RAW_DATA_URL, e)
+            return
+
+        logger.info('Lookup loaded from cache')
+        if self._expired(meta.get('lastChecked')):
+            # serve from cache now, and swap in the new lookups if upstream has changed
+            t = threading.Thread(target=self._revalidate, args=(meta['lastModified'],), daemon=True)
+            t.start()
+
+    def _load_cache(self):
+        # a missing or corrupt file reloads them all from source
+        nations = datafile.load_cache(Lookups._LU_FILE_NATIONS)
+        leagues = datafile.load_cache(Lookups._LU_FILE_LEAGUES)
+        teams   = datafile.load_cache(Lookups._LU_FILE_TEAMS)
+        if not (nations and leagues and teams):
+            return False
+        self.nations.items = nations
+        self.leagues.items = leagues
+        self.teams.items   = teams
+        return True
+
+    def _revalidate(self, last_modified):
+        try:
+            if self._modified_since(last_modified):
+                self._reload()
+                logger.info('Lookup reloaded from source')
+            else:
+                self._save_meta(lastChecked=time.time())
+        except requests.exceptions.RequestException as e:
+            logger.warning('Failed to check %s for update: %s', Lookups._RAW_DATA_URL, e)
+
+    def _expired(self, last_checked):
+        return last_checked is None or time.time() - last_checked > self.max_age
 
     def _reload(self):
-        r = requests.get(Lookups._RAW_DATA_URL)
-        raw = r.json()
+        r = httpclient.get(Lookups._RAW_DATA_URL)
+        r.raise_for_status()
+        # the keys are base64 encoded. only decode the ones that can possibly match one of
+        # the prefixes - the loc file has tens of thousands of keys we don't care about
+        wanted = _b64_prefixes(list(Lookups._RAW_KEY_PREFIXES_NATION.values()) +
+                               list(Lookups._RAW_KEY_PREFIXES_LEAGUE.values()) +
+                               list(Lookups._RAW_KEY_PREFIXES_TEAM.values()))
+        raw = r.json(object_pairs_hook=lambda pairs: [(k, v) for k, v in pairs if k.startswith(wanted)])
 
         # use temp maps as workspace when parsing through raw input
         nations = {}
         leagues = {}
         teams = {}
-        for k, v in raw.items():
+        for k, v in raw:
             key = base64.b64decode(k).decode('utf-8')
             self._update(nations, Lookups._RAW_KEY_PREFIXES_NATION, key, v)
             self._update(leagues, Lookups._RAW_KEY_PREFIXES_LEAGUE, key, v)
@@ -88,12 +215,12 @@ class Lookups(object):
         datafile.save_json(self.nations.items, Lookups._LU_FILE_NATIONS)
         datafile.save_json(self.leagues.items, Lookups._LU_FILE_LEAGUES)
         datafile.save_json(self.teams.items, Lookups._LU_FILE_TEAMS)
-        datafile.save_json({'lastModified': r.headers['Last-Modified']}, Lookups._LU_FILE_META)
+        self._save_meta(lastModified=r.headers['Last-Modified'], lastChecked=time.time())
 
 
     def _modified_since(self, time_str):
         headers = {'If-Modified-Since': time_str}
-        r = requests.head(Lookups._RAW_DATA_URL, headers = headers)
+        r = httpclient.head(Lookups._RAW_DATA_URL, headers = headers)
         return r.status_code != 304
 
     def _update(self, d, raw_key_prefixes, key, raw_value):
@@ -108,10 +235,31 @@ class Lookups(object):
 
 
 class LookupStore(object):
+
+    _INDEXED_PROPS = ['id', 'abbr', 'abbr2', 'name']
+
     def __init__(self, name):
         self.name = name
         self.items = []
 
+    @property
+    def items(self):
+        return self._state[0]
+
+    @items.setter
+    def items(self, items):
+        # rebuild the per-property indexes whenever the items are (re)assigned. the first
+        # item wins for duplicate values, same as the linear scan used to do
+        indexes = {prop: {} for prop in LookupStore._INDEXED_PROPS}
+        for i in items:
+            for prop, index in indexes.items():
+                if prop in i:
+                    index.setdefault(i[prop], i)
+        name_index = NameIndex((i, i['name']) for i in items if i.get('name'))
+        # Lookups._revalidate swaps in new items from its own thread. one assignment keeps
+        # readers from seeing the new items with the old indexes, or the other way round
+        self._state = (items, indexes, name_index)
+
     def by_id(self, val):
         return self._by_prop('id', val)
 
@@ -125,17 +273,23 @@ class LookupStore(object):
         return self._by_prop('name', val)
 
     def _by_prop(self, prop, val):
-        a = [i for i in self.items if prop in i and i[prop] == val]
-        return a[0] if len(a) > 0 else None
+        return self._state[1][prop].get(val)
 
     def name_contains(self, val):
-        return [i for i in self.items if val in i['name']]
+        return self._state[2].search(val)
 
     def find(self, val):
         if not isinstance(val, list):
             val = [val]
-        result = [self._find_single(v) for v in val]
-        return [x for x in result if x is not None]
+        result = []
+        for v in val:
+            x = self._find_single(v)
+            # partial name matches come back as a list
+            if isinstance(x, list):
+                result.extend(x)
+            elif x is not None:
+                result.append(x)
+        return result
 
     def _find_single(self, val):
         if isinstance(val, int): return self.by_id(val)
@@ -158,6 +312,77 @@ class LookupStore(object):
         item = self.by_id(id)
         return item[prop] if item is not None and prop in item else None
 
+class NameIndex(object):
+    '''Trigram index over case- and accent-folded names
+
+    Each entry is a (value, name) pair. search() returns the values whose name contains
+    the query, in the order the entries were added.
+    '''
+
+    _N = 3
+
+    def __init__(self, entries):
+        self._values = []
+        self._names = []
+        self._grams = {}
+        for value, name in entries:
+            pos = len(self._values)
+            folded = fold(name)
+            self._values.append(value)
+            self._names.append(folded)
+            for g in _ngrams(folded, NameIndex._N):
+                self._grams.setdefault(g, []).append(pos)
+
+    def __len__(self):
+        return len(self._values)
+
+    def search(self, val):
+        q = fold(val)
+        if len(q) < NameIndex._N:
+            # too short to use the grams. the folded names are still cheap to scan
+            candidates = range(len(self._names))
+        else:
+            postings = sorted([self._grams.get(g, []) for g in _ngrams(q, NameIndex._N)], key=len)
+            candidates = set(postings[0])
+            for p in postings[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(p)
+            candidates = sorted(candidates)
+        # the grams only narrow down the candidates - confirm the actual substring match
+        result, seen = [], set()
+        for pos in candidates:
+            if q in self._names[pos] and id(self._values[pos]) not in seen:
+                seen.add(id(self._values[pos]))
+                result.append(self._values[pos])
+        return result
+
+def fold(s):
+    '''Lower case and strip the accents, e.g. 'Agüero' -> 'aguero' '''
+    s = unicodedata.normalize('NFKD', s)
+    return ''.join(c for c in s if not unicodedata.combining(c)).casefold()
+
+def _b64_prefixes(prefixes):
+    '''Returns the base64 encoded forms that keys starting with the prefixes must start with
+
+    Only whole 3-byte groups encode to a stable base64 prefix, so a prefix is truncated to a
+    multiple of 3 bytes before encoding. Matching keys still need to be checked after decoding.
+    '''
+    result = set()
+    for p in prefixes:
+        b = p.encode('utf-8')
+        result.add(base64.b64encode(b[:len(b) // 3 * 3]).decode('ascii'))
+    return tuple(result)
+
+def _player_names(players):
+    for p in players.values():
+        yield p, u'{} {}'.format(p['firstname'], p['lastname'])
+        if p['surname']:
+            yield p, p['surname']
+
+def _ngrams(s, n):
+    return set(s[i:i+n] for i in range(len(s) - n + 1))
+
 def main():
     logging.basicConfig(level = logging.INFO)
     lu = Lookups(force_reload=False)
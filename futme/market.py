@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# observations younger than this are trusted to describe the market as it is now
+FRESH_FOR = 30
+
+class MarketObservations(object):
+    '''Transfer market listings seen in search results, keyed by resourceId
+
+    Every search result is recorded here so that other lookups on the same resourceId can
+    reuse it. A search that returned less than a full page is also recorded as complete:
+    at that time there was nothing listed at or below max_buy except what it returned.
+    The observer who made it (e.g. a trader) is kept with it, see nothing_below().
+
+    Listings are dropped once they expire or get older than retention seconds.
+    '''
+
+    def __init__(self, retention=3600):
+        self.retention = retention
+        self._lock = threading.Lock()
+        # rid -> {tradeId: (item, observed_at, expires_at)}
+        self._listings = {}
+        # rid -> (max_buy, observed_at, observer) of the latest complete search
+        self._complete = {}
+        self._last_sweep = time.time()
+
+    def record(self, rid, max_buy, search_result, page_size, observer=None):
+        '''Record the result of a search
+
+        :param rid: the resourceId searched for, or None if the search was not by resourceId
+        :param observer: (optional) who searched, e.g. the trader
+        '''
+        now = time.time()
+        with self._lock:
+            for x in search_result:
+                listings = self._listings.setdefault(x['resourceId'], {})
+                listings[x['tradeId']] = (x, now, now + x['expires'])
+            if rid is not None and len(search_result) < page_size:
+                self._complete[rid] = (max_buy, now, observer)
+            if now - self._last_sweep > 300:
+                self._sweep(now)
+
+    def remove(self, rid, trade_id):
+        '''Forget a listing, e.g. after we have bought it or failed to'''
+        with self._lock:
+            self._listings.get(rid, {}).pop(trade_id, None)
+
+    def listings(self, rid, max_age=FRESH_FOR):
+        '''Listings of rid seen in the last max_age seconds that have not expired yet'''
+        now = time.time()
+        with self._lock:
+            return [x for x, observed_at, expires_at in self._listings.get(rid, {}).values()
+                    if now - observed_at <= max_age and expires_at > now]
+
+    def floor(self, rid, max_age=FRESH_FOR):
+        '''Returns a price p such that nothing but the fresh listings is listed at or below p
+
+        None if there is no complete search of rid in the last max_age seconds.
+        '''
+        with self._lock:
+            max_buy, observed_at, _ = self._complete.get(rid, (None, 0, None))
+        return max_buy if time.time() - observed_at <= max_age else None
+
+    def nothing_below(self, rid, max_buy, max_age=FRESH_FOR, observer=None):
+        '''True if we know, from fresh observations, that nothing is listed at or below max_buy
+
+        Observations of observer itself do not count: a trader polls at its own interval,
+        and only skips a search when someone else has just made it.
+        '''
+        with self._lock:
+            _, _, complete_observer = self._complete.get(rid, (None, 0, None))
+        if observer is not None and complete_observer is observer:
+            return False
+        floor = self.floor(rid, max_age)
+        if floor is None or floor < max_buy:
+            return False
+        return not [x for x in self.listings(rid, max_age) if x['buyNowPrice'] <= max_buy]
+
+    def _sweep(self, now):
+        for rid in list(self._listings):
+            listings = self._listings[rid]
+            for trade_id in [k for k, (_, observed_at, expires_at) in listings.items()
+                             if expires_at <= now or now - observed_at > self.retention]:
+                del listings[trade_id]
+            if not listings:
+                del self._listings[rid]
+        for rid in [k for k, (_, observed_at, _) in self._complete.items() if now - observed_at > self.retention]:
+            del self._complete[rid]
+        self._last_sweep = now
+
+observations = MarketObservations()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import contextlib
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+from . import datafile
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram(object):
+
+    def __init__(self):
+        # one count per bucket, plus one for everything slower than the last bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        '''Upper bound of the bucket the q-quantile falls in (inf if past the last bucket)'''
+        if self.count == 0:
+            return 0
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+
+class Metrics(object):
+    '''Counts, errors and latency histograms of calls, keyed by (kind, endpoint)
+
+    Kinds are 'fut' (FUT session calls, by method), 'http' (futbin, futhead and lookup
+    requests, by host and path) and 'task' (LoopyTask runs, by task name).
+
+    with metrics.registry.timed('fut', 'search'):
+        session.search(...)
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.calls = {}
+        self.errors = {}
+        self.latency = {}
+        self.response_bytes = {}
+
+    def observe(self, kind, endpoint, seconds, error=False):
+        key = (kind, endpoint)
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            if error:
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if key not in self.latency:
+                self.latency[key] = Histogram()
+            self.latency[key].observe(seconds)
+
+    def add_bytes(self, kind, endpoint, n):
+        key = (kind, endpoint)
+        with self._lock:
+            self.response_bytes[key] = self.response_bytes.get(key, 0) + n
+
+    @contextlib.contextmanager
+    def timed(self, kind, endpoint):
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.observe(kind, endpoint, time.time() - start, error=True)
+            raise
+        self.observe(kind, endpoint, time.time() - start)
+
+    def summary(self, kind):
+        '''One line per endpoint of kind, busiest first'''
+        with self._lock:
+            keys = sorted([k for k in self.calls if k[0] == kind], key=lambda k: -self.calls[k])
+            lines = []
+            for k in keys:
+                h = self.latency[k]
+                line = '{} n={} err={} mean={:.0f}ms p50<={:.0f}ms p95<={:.0f}ms'.format(
+                    k[1], self.calls[k], self.errors.get(k, 0), h.sum / h.count * 1000,
+                    h.quantile(0.5) * 1000, h.quantile(0.95) * 1000)
+                if k in self.response_bytes:
+                    line += ' {:.0f}KB'.format(self.response_bytes[k] / 1024.0)
+                lines.append(line)
+            return lines
+
+    def prometheus_text(self):
+        '''The metrics in the Prometheus text exposition format'''
+        lines = [
+            '# HELP futme_calls_total Calls made, by kind and endpoint.',
+            '# TYPE futme_calls_total counter'
+        ]
+        with self._lock:
+            keys = sorted(self.calls)
+            for k in keys:
+                lines.append('futme_calls_total{{{}}} {}'.format(_labels(k), self.calls[k]))
+            lines.append('# HELP futme_errors_total Calls that raised, by kind and endpoint.')
+            lines.append('# TYPE futme_errors_total counter')
+            for k in keys:
+                lines.append('futme_errors_total{{{}}} {}'.format(_labels(k), self.errors.get(k, 0)))
+            lines.append('# HELP futme_response_bytes_total Bytes received, by kind and endpoint.')
+            lines.append('# TYPE futme_response_bytes_total counter')
+            for k in sorted(self.response_bytes):
+                lines.append('futme_response_bytes_total{{{}}} {}'.format(_labels(k), self.response_bytes[k]))
+            lines.append('# HELP futme_latency_seconds Call latency, by kind and endpoint.')
+            lines.append('# TYPE futme_latency_seconds histogram')
+            for k in keys:
+                h = self.latency[k]
+                cumulative = 0
+                for le, n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    lines.append('futme_latency_seconds_bucket{{{},le="{}"}} {}'.format(_labels(k), le, cumulative))
+                lines.append('futme_latency_seconds_bucket{{{},le="+Inf"}} {}'.format(_labels(k), h.count))
+                lines.append('futme_latency_seconds_sum{{{}}} {:.6f}'.format(_labels(k), h.sum))
+                lines.append('futme_latency_seconds_count{{{}}} {}'.format(_labels(k), h.count))
+        lines.append('# HELP futme_start_time_seconds When the process started collecting metrics.')
+        lines.append('# TYPE futme_start_time_seconds gauge')
+        lines.append('futme_start_time_seconds {:.0f}'.format(self.started))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        '''Writes the metrics to path, e.g. for the node_exporter textfile collector
+
+        Written to a temp file and renamed into place, so scrapes never see a partial file.
+        '''
+        text = self.prometheus_text()
+        with datafile.atomic_open(path, 'w') as f:
+            f.write(text)
+
+
+def _labels(key):
+    return 'kind="{}",endpoint="{}"'.format(*[x.replace('\\', '\\\\').replace('"', '\\"') for x in key])
+
+def url_endpoint(url, method='GET'):
+    '''Method, host and path of url, without the query and the path segments with ids in them
+
+    https://www.futbin.com/19/playerPrices?player=123 -> GET www.futbin.com/playerPrices
+    '''
+    parts = urlsplit(url)
+    path = [x for x in parts.path.split('/') if x and not re.search(r'\d', x)]
+    return '{} {}'.format(method, '/'.join([parts.netloc] + path))
+
+registry = Metrics()
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import concurrent.futures
 import logging
+import math
+import os
+import threading
 import time
 import statistics
+from array import array
 
+import numpy as np
 import requests
-from beaker.cache import cache_region, cache_regions
+from beaker.cache import Cache, cache_region, cache_regions, region_invalidate
 
-from . import timeutil
+from . import datafile, httpclient, pricestore, timeutil
 
 logger = logging.getLogger(__name__)
 
@@ -22,12 +29,34 @@ PRICE_STEP_SIZES = [
 ]
 
 cache_regions.update({
+    'price_quick':{
+        'expire': 300,
+        'type': 'memory'
+    },
     'price_history':{
-        'expire': 3600,
+        'expire': 300,
         'type': 'memory'
     }
 })
 
+# futbin requests in flight at once for quick_many and history_many
+MAX_CONCURRENT_REQUESTS = 8
+
+# futbin price graphs: (type, source in the price store, days ago it ends, min seconds between fetches)
+_GRAPHS = [
+    ('daily_graph', pricestore.DAILY, 0, 6 * timeutil.SECONDS_PER_HOUR),
+    ('today', pricestore.HOURLY, 0, timeutil.SECONDS_PER_HOUR),
+    ('yesterday', pricestore.HOURLY, 1, timeutil.SECONDS_PER_HOUR),
+    ('da_yesterday', pricestore.HOURLY, 2, timeutil.SECONDS_PER_HOUR)
+]
+
+# what futbin requests go through: anything with get_json(url), like benchmarks.sim.SimFutbin
+futbin_client = httpclient.client
+
+_PRICE_STORE_FILE = 'prices.db'
+_store = None
+_store_lock = threading.Lock()
+
 def pbound(price):
     if price < 0:
         return 0
@@ -36,103 +65,303 @@ def pbound(price):
     return price
 
 def pround(price):
-    price = pbound(price)
-
-    for bucket_upper_bound, step_size in PRICE_STEP_SIZES:
-        if price < bucket_upper_bound:
-            return int(round(price / float(step_size))) * step_size
-
-    return int(round(price / 1000.0)) * 1000
+    '''price rounded to a valid price. Below MIN_PRICE (discard values) in steps of 50 from 0'''
+    if price < MIN_PRICE:
+        step = PRICE_STEP_SIZES[0][1]
+        return min(int(round(pbound(price) / float(step))) * step, MIN_PRICE)
+    return LADDER.round(price)
 
 def pincrement(price, steps = 1):
+    '''price moved steps ticks up (or down, for negative steps). Never below 0'''
     result = pround(price)
-    for _ in range(abs(steps)):
-        if steps > 0:
-            delta = 1000
-            for bucket_upper_bound, step_size in PRICE_STEP_SIZES:
-                if result < bucket_upper_bound:
-                    delta = step_size
-                    break
-        else:
-            delta = -1000
-            for bucket_upper_bound, step_size in PRICE_STEP_SIZES:
-                if result <= bucket_upper_bound:
-                    delta = -step_size
-                    break
-        result += delta
-    return pbound(result)
+    if result >= MIN_PRICE:
+        index = LADDER.index(result) + steps
+    else:
+        # ticks below the ladder count down from its first price
+        index = (result - MIN_PRICE) // PRICE_STEP_SIZES[0][1] + steps
+    if index >= 0:
+        return LADDER.price_at(index)
+    return max(MIN_PRICE + index * PRICE_STEP_SIZES[0][1], 0)
+
+
+class PriceLadder(object):
+    """All valid prices from MIN_PRICE to MAX_PRICE, addressable by tick index
+
+    ladder = PriceLadder()
+    ladder.round(1234)          # 1200
+    ladder.increment(950, 2)    # 1100
+    ladder.distance(950, 1100)  # 2
+    ladder.midpoint(150, 1000)  # 550
+
+    Prices are clamped to [MIN_PRICE, MAX_PRICE], so the results are always valid
+    listing prices.
+    """
+
+    def __init__(self, min_price=MIN_PRICE, max_price=MAX_PRICE, step_sizes=PRICE_STEP_SIZES):
+        self.min_price = min_price
+        self.max_price = max_price
+        # each band is (lower bound, step size, tick index of lower bound). bands are
+        # looked up by bisecting their upper bounds
+        self._bands = []
+        self._uppers = []
+        prices = array('l')
+        lower = min_price
+        for upper, step in step_sizes + [(max_price + 1000, 1000)]:
+            if upper <= lower:
+                continue
+            self._bands.append((lower, step, len(prices)))
+            self._uppers.append(upper)
+            prices.extend(range(lower, min(upper, max_price + 1), step))
+            lower = upper
+        self._prices = prices
+        self._np_prices = np.array(prices)
+        self._np_uppers = np.array(self._uppers)
+        self._np_lowers = np.array([b[0] for b in self._bands])
+        self._np_steps = np.array([b[1] for b in self._bands])
+        self._np_bases = np.array([b[2] for b in self._bands])
+
+    def __len__(self):
+        return len(self._prices)
+
+    def round(self, price):
+        return self._prices[self.index(price)]
+
+    def index(self, price):
+        """Tick index of the price after rounding"""
+        price = min(max(price, self.min_price), self.max_price)
+        lower, step, base = self._bands[bisect.bisect_right(self._uppers, price)]
+        # rounding can land on the upper bound of the band, which is the first tick of
+        # the next band - the index arithmetic works out the same
+        return min(base + (int(round(price / float(step))) * step - lower) // step, len(self._prices) - 1)
+
+    def price_at(self, index):
+        return self._prices[min(max(index, 0), len(self._prices) - 1)]
+
+    def increment(self, price, steps=1):
+        return self.price_at(self.index(price) + steps)
+
+    def decrement(self, price, steps=1):
+        return self.price_at(self.index(price) - steps)
+
+    def midpoint(self, price1, price2):
+        """The price half way between two prices, counting in ticks rather than coins"""
+        return self.price_at((self.index(price1) + self.index(price2)) // 2)
+
+    def distance(self, price1, price2):
+        """Number of ticks from price1 to price2 (negative if price2 is lower)"""
+        return self.index(price2) - self.index(price1)
+
+    def round_array(self, prices):
+        """Vectorized round() for an array of prices"""
+        p = np.clip(np.asarray(prices, dtype=float), self.min_price, self.max_price)
+        steps = self._np_steps[np.searchsorted(self._np_uppers, p, side='right')]
+        return (np.round(p / steps) * steps).astype(np.int64)
+
+    def index_array(self, prices):
+        """Vectorized index() for an array of prices"""
+        rounded = self.round_array(prices)
+        band = np.minimum(np.searchsorted(self._np_uppers, rounded, side='right'), len(self._bands) - 1)
+        return self._np_bases[band] + (rounded - self._np_lowers[band]) // self._np_steps[band]
+
+    def price_at_array(self, indexes):
+        """Vectorized price_at() for an array of tick indexes"""
+        return self._np_prices[np.clip(np.asarray(indexes), 0, len(self._prices) - 1)]
+
+LADDER = PriceLadder()
 
 
 def quick(player):
-    rid = str(player['resourceId'] if isinstance(player, dict) else player)
+    try:
+        return _quick(str(_rid(player)))
+    except LookupError:
+        return 0
+
+@cache_region('price_quick', 'quick')
+def _quick(rid):
     data = futbin_get_json('https://www.futbin.com/19/playerPrices?player=' + rid)
-    if data is None: return 0
+    if data is None:
+        # raise rather than return, so that the failure is not cached
+        raise LookupError('No futbin price for ' + rid)
     v = data[rid]['prices']['ps']['LCPrice']
     if isinstance(v, int):
         return v
     return int(v.replace(',', ''))
 
+def quick_cached(player):
+    '''quick(player) if it is in the cache, else None. Never makes a request'''
+    cache = Cache._get_cache(_quick._arg_namespace, cache_regions['price_quick'])
+    try:
+        # the key cache_region gives it: its name and the args
+        return cache.get('quick ' + str(_rid(player)))
+    except KeyError:
+        return None
+
+def quick_many(players):
+    '''Quick prices of players (dicts or resourceIds) as a dict of resourceId -> price
+
+    Each resourceId is fetched once, MAX_CONCURRENT_REQUESTS at a time, and cached the same
+    as with quick().
+    '''
+    return _map_concurrent(quick, players)
+
 
 def history(player, include_hourly=0):
-    rid = str(player['resourceId'] if isinstance(player, dict) else player)
-    return _history(rid, include_hourly)
+    '''Price history of player from the local price store
+
+    The futbin daily graph is always included, and include_hourly (1 to 3) adds the hourly
+    graphs of today, yesterday and the day before, along with our own market prices of the
+    same days. The graphs are only fetched from futbin if they may have points newer than
+    the stored ones.
+
+    Where sources have a point at the same timestamp, market prices win over hourly and
+    hourly over daily points. Histories are cached for a few minutes, except that a new
+    market price (see record_market_price()) is seen right away.
+    '''
+    return _history(_rid(player), include_hourly)
 
 @cache_region('price_history', 'history')
 def _history(rid, include_hourly):
-    d = {}
-
-    def futbin_price_graph(gtype):
+    _update_history(rid, include_hourly)
+    return stored_history(rid, include_hourly)
+
+def stored_history(player, include_hourly=0):
+    '''The same as history(), but only what is in the price store: nothing is fetched, or cached'''
+    rid = _rid(player)
+    s = store()
+    # sources in order of precedence, lowest first
+    columns = [s.points(rid, [pricestore.DAILY])]
+    if include_hourly > 0:
+        # the start of the day of the oldest hourly graph included
+        since = _day_start() - _GRAPHS[:1 + include_hourly][-1][2] * timeutil.SECONDS_PER_DAY
+        columns += [s.points(rid, [pricestore.HOURLY], since=since),
+                    s.points(rid, [pricestore.MARKET], since=since)]
+    rows = np.concatenate([np.array(c, dtype=np.int64).reshape(-1, 2) for c in columns])
+    precedence = np.concatenate([np.full(len(c), i) for i, c in enumerate(columns)])
+    # by timestamp, then precedence. the last row of each timestamp is the one to keep
+    rows = rows[np.lexsort((precedence, rows[:, 0]))]
+    rows = rows[np.append(rows[1:, 0] != rows[:-1, 0], True)] if len(rows) else rows
+    return PriceHistory.from_columns(np.ascontiguousarray(rows[:, 0]), np.ascontiguousarray(rows[:, 1]))
+
+def history_many(players, include_hourly=0):
+    '''Price histories of players as a dict of resourceId -> PriceHistory. See quick_many()'''
+    return _map_concurrent(lambda rid: history(rid, include_hourly), players)
+
+def _rid(player):
+    return player['resourceId'] if isinstance(player, dict) else int(player)
+
+def _map_concurrent(func, players):
+    rids = list(dict.fromkeys(_rid(p) for p in players))
+    if len(rids) <= 1:
+        return {rid: func(rid) for rid in rids}
+    with concurrent.futures.ThreadPoolExecutor(min(MAX_CONCURRENT_REQUESTS, len(rids))) as executor:
+        return dict(zip(rids, executor.map(func, rids)))
+
+def _day_start():
+    return int(time.time()) // timeutil.SECONDS_PER_DAY * timeutil.SECONDS_PER_DAY
+
+def _update_history(rid, include_hourly):
+    s = store()
+    today = _day_start()
+    for gtype, source, days_ago, min_interval in _GRAPHS[:1 + include_hourly]:
+        # a graph of a past day is complete once the day is over
+        period_end = float('inf') if days_ago == 0 else today - (days_ago - 1) * timeutil.SECONDS_PER_DAY
+        if not s.needs_fetch(rid, gtype, period_end, min_interval):
+            continue
         url = 'https://www.futbin.com/19/playerGraph?type={}&year=19&player={}'.format(gtype, rid)
         data = futbin_get_json(url)
         if data is None:
-            return
-        if 'ps' in data:
-            for k, v in data['ps']:
-                t = int(k/1000)
-                d[t] = PricePoint(t, v)
-
-    # order is important as we want more recent data to override older want
-    futbin_price_graph('daily_graph')
-    if include_hourly >= 1:
-        futbin_price_graph('today')
-    if include_hourly >= 2:
-        futbin_price_graph('yesterday')
-    if include_hourly >= 3:
-        futbin_price_graph('da_yesterday')
-
-
-    return PriceHistory(sorted(d.values(), key=lambda x: x.timestamp, reverse=True))
+            # not marked as fetched, so the next call tries again
+            continue
+        s.add_points(rid, source, [(int(k/1000), v) for k, v in data.get('ps', [])])
+        s.set_fetched(rid, gtype)
+
+def record_market_price(player, value):
+    '''Add a min price found on the transfer market to the price history of player'''
+    rid = _rid(player)
+    store().add_points(rid, pricestore.MARKET, [(time.time(), value)])
+    for include_hourly in range(1, len(_GRAPHS)):
+        region_invalidate(_history, None, 'history', rid, include_hourly)
+
+def store():
+    '''The PriceStore in the db dir, opened on first use'''
+    global _store
+    with _store_lock:
+        if _store is None:
+            os.makedirs(datafile.DB_DIR, exist_ok=True)
+            _store = pricestore.PriceStore(datafile.dbfilepath(_PRICE_STORE_FILE))
+        return _store
 
 def futbin_get_json(url):
-    for _ in range(3):
-        try:
-            return requests.get(url).json()
-        except:
-            continue
-    return None
+    try:
+        return futbin_client.get_json(url)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning('Failed to get %s: %s', url, e)
+        return None
 
 class PriceHistory(object):
+    '''Price points of a player, as timestamp and value columns sorted by timestamp
+
+    Slices are views of the same columns. Sums and sums of squares are kept as prefix sums
+    and range min/max as a sparse table, so mean, stdev, high and low of any slice take
+    constant time once the columns are built.
+    '''
 
     def __init__(self, points):
-        self.points = sorted(points, key=lambda x: x.timestamp, reverse=True)
+        points = sorted(points, key=lambda x: x.timestamp)
+        self._cols = _PriceColumns(np.array([x.timestamp for x in points], dtype=np.int64),
+                                   np.array([x.value for x in points], dtype=np.int64))
+        self._lo, self._hi = 0, len(points)
+
+    @classmethod
+    def from_columns(cls, timestamps, values):
+        '''A PriceHistory of numpy arrays of timestamps (ascending) and values'''
+        h = cls.__new__(cls)
+        h._cols = _PriceColumns(timestamps, values)
+        h._lo, h._hi = 0, len(timestamps)
+        return h
+
+    def _view(self, lo, hi):
+        h = PriceHistory.__new__(PriceHistory)
+        h._cols, h._lo, h._hi = self._cols, lo, hi
+        return h
+
+    def __len__(self):
+        return self._hi - self._lo
+
+    @property
+    def points(self):
+        '''The PricePoints, latest first'''
+        ts, vs = self._cols.timestamps, self._cols.values
+        return [PricePoint(int(ts[i]), int(vs[i])) for i in range(self._hi - 1, self._lo - 1, -1)]
+
+    def columns(self):
+        '''numpy views of the timestamps (ascending) and values'''
+        return self._cols.timestamps[self._lo:self._hi], self._cols.values[self._lo:self._hi]
 
     def high(self):
-        return max(self.points, key=lambda x: x.value)
+        return self._point(self._cols.argmax(self._lo, self._hi))
 
     def low(self):
-        return min(self.points, key=lambda x: x.value)
+        return self._point(self._cols.argmin(self._lo, self._hi))
 
     def mean(self):
-        return statistics.mean(self.values())
+        n = len(self)
+        if n < 1:
+            raise statistics.StatisticsError('mean requires at least one data point')
+        return self._cols.sum(self._lo, self._hi) / n
 
     def stdev(self):
-        return statistics.stdev(self.values())
+        n = len(self)
+        if n < 2:
+            raise statistics.StatisticsError('stdev requires at least two data points')
+        s, sq = self._cols.sum(self._lo, self._hi), self._cols.sum_of_squares(self._lo, self._hi)
+        return math.sqrt((n * sq - s * s) / (n * (n - 1)))
 
     def values(self):
-        return [x.value for x in self.points]
+        return self._cols.values[self._lo:self._hi][::-1].tolist()
 
     def latest_price(self):
-        return self.points[0].value if self.points else None
+        return int(self._cols.values[self._hi - 1]) if len(self) else None
 
     def slice(self, *days_offsets):
         """
@@ -154,11 +383,17 @@ class PriceHistory(object):
             t1 = abs(days_offsets[0]) * timeutil.SECONDS_PER_DAY
             t2 = abs(days_offsets[1]) * timeutil.SECONDS_PER_DAY
         now = time.time()
-        return PriceHistory([p for p in self.points if p.time_within(now - t1, now - t2)])
+        start, end = sorted([now - t1, now - t2])
+        ts = self._cols.timestamps[self._lo:self._hi]
+        lo, hi = np.searchsorted(ts, [start, end], side='left')
+        return self._view(self._lo + int(lo), self._lo + int(hi))
 
     def add(self, current_price):
-        pp = PricePoint(int(time.time()), current_price)
-        self.points.insert(0, pp)
+        ts = np.append(self._cols.timestamps[self._lo:self._hi], int(time.time()))
+        vs = np.append(self._cols.values[self._lo:self._hi], current_price)
+        order = np.argsort(ts, kind='stable')
+        self._cols = _PriceColumns(ts[order], vs[order])
+        self._lo, self._hi = 0, len(ts)
 
     def trade_score(self, price, days=90):
         s = self.slice(days)
@@ -166,6 +401,66 @@ class PriceHistory(object):
         stdev = s.stdev()
         return round(float(price - mean)/stdev, 1)
 
+    def _point(self, i):
+        return PricePoint(int(self._cols.timestamps[i]), int(self._cols.values[i]))
+
+
+class _PriceColumns(object):
+    '''The columns behind a PriceHistory and its slices, with the tables for range stats'''
+
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+        # integer sums, so that variances come out exact however far apart the prices are.
+        # int64 holds the sums of squares of any realistic history. fall back to python ints
+        # for the rest
+        peak = int(np.abs(values).max()) if len(values) else 0
+        dtype = np.int64 if (len(values) + 1) * peak * peak < 2 ** 62 else object
+        v = values.astype(dtype)
+        self._sums = np.concatenate([np.zeros(1, dtype=dtype), np.cumsum(v)])
+        self._squares = np.concatenate([np.zeros(1, dtype=dtype), np.cumsum(v * v)])
+        self._max_table = None
+        self._min_table = None
+
+    def sum(self, lo, hi):
+        return int(self._sums[hi] - self._sums[lo])
+
+    def sum_of_squares(self, lo, hi):
+        return int(self._squares[hi] - self._squares[lo])
+
+    def argmax(self, lo, hi):
+        if self._max_table is None:
+            self._max_table = self._sparse_table(np.greater_equal)
+        return self._query(self._max_table, np.greater_equal, lo, hi)
+
+    def argmin(self, lo, hi):
+        if self._min_table is None:
+            self._min_table = self._sparse_table(np.less_equal)
+        return self._query(self._min_table, np.less_equal, lo, hi)
+
+    def _sparse_table(self, better_or_equal):
+        # level k holds the index of the best value in [i, i + 2^k). ties go to the later
+        # (more recent) point, as PriceHistory.high() and low() always have
+        v = self.values
+        table = [np.arange(len(v))]
+        width = 1
+        while width * 2 <= len(v):
+            prev = table[-1]
+            left, right = prev[:len(prev) - width], prev[width:]
+            table.append(np.where(better_or_equal(v[right], v[left]), right, left))
+            width *= 2
+        return table
+
+    def _query(self, table, better_or_equal, lo, hi):
+        if hi <= lo:
+            raise ValueError('empty price history')
+        k = (hi - lo).bit_length() - 1
+        i, j = table[k][lo], table[k][hi - (1 << k)]
+        v = self.values
+        if v[i] == v[j]:
+            return max(i, j)
+        return j if better_or_equal(v[j], v[i]) else i
+
 class PricePoint(object):
     def __init__(self, timestamp, value):
         self.timestamp = timestamp
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import sqlite3
+import threading
+import time
+
+from . import timeutil
+
+logger = logging.getLogger(__name__)
+
+# where a price point came from
+DAILY = 'daily'      # futbin daily graph
+HOURLY = 'hourly'    # futbin hourly graphs (today, yesterday, da_yesterday)
+MARKET = 'market'    # min buy now price found by our own searches
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS points (
+    rid INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (rid, source, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fetches (
+    rid INTEGER NOT NULL,
+    graph TEXT NOT NULL,
+    fetched_at INTEGER NOT NULL,
+    PRIMARY KEY (rid, graph)
+) WITHOUT ROWID;
+'''
+
+class PriceStore(object):
+    '''Price points of players in a SQLite file, by resourceId and source
+
+    Points are only ever added (or replaced, if a source reports the same timestamp again),
+    so that each fetch of a futbin graph merges into what is already stored. The store also
+    remembers when each graph of each player was last fetched, so that callers can tell
+    whether a graph can have anything newer than what is stored (see needs_fetch()).
+
+    Hourly and market points older than retention seconds are dropped when the store is
+    opened. Daily points are kept.
+
+    Safe to use from multiple threads, and from multiple processes (WAL mode).
+    '''
+
+    def __init__(self, path, retention=90 * timeutil.SECONDS_PER_DAY):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+            self._conn.execute('DELETE FROM points WHERE source != ? AND ts < ?',
+                               (DAILY, int(time.time() - retention)))
+
+    def add_points(self, rid, source, points):
+        '''Merge points, an iterable of (timestamp, value), into the points of rid from source'''
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO points (rid, source, ts, value) VALUES (?, ?, ?, ?)',
+                                   [(rid, source, int(ts), int(v)) for ts, v in points])
+
+    def points(self, rid, sources, since=None, until=None):
+        '''(timestamp, value) of rid from the given sources in [since, until), newest first'''
+        sql = 'SELECT ts, value FROM points WHERE rid = ? AND source IN ({})'.format(','.join('?' * len(sources)))
+        args = [rid] + list(sources)
+        if since is not None:
+            sql += ' AND ts >= ?'
+            args.append(int(since))
+        if until is not None:
+            sql += ' AND ts < ?'
+            args.append(int(until))
+        sql += ' ORDER BY ts DESC'
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def fetched_at(self, rid, graph):
+        with self._lock:
+            row = self._conn.execute('SELECT fetched_at FROM fetches WHERE rid = ? AND graph = ?', (rid, graph)).fetchone()
+        return row[0] if row else None
+
+    def set_fetched(self, rid, graph, fetched_at=None):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO fetches (rid, graph, fetched_at) VALUES (?, ?, ?)',
+                               (rid, graph, int(time.time() if fetched_at is None else fetched_at)))
+
+    def needs_fetch(self, rid, graph, period_end, min_interval):
+        '''True if a graph covering up to period_end may have points we have not stored yet
+
+        That is, unless it was fetched after period_end (nothing can have been added since),
+        or less than min_interval seconds ago.
+        '''
+        fetched_at = self.fetched_at(rid, graph)
+        if fetched_at is None:
+            return True
+        return fetched_at < period_end and time.time() - fetched_at >= min_interval
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -22,12 +22,12 @@ class Proc(object):
             self.refresh_tradepile()
 
             # check room on transfer list
-            vacancy = self.fme.session().tradepile_size - len(self.fme.session().tradepile())
+            vacancy = self.fme.session().tradepile_size - len(self.fme.tm.tradepile)
             logger.info('%s open spots left on the transfer list.', vacancy)
             if vacancy < 15:
                 logger.warning('It is nearly full. Not buying new packs.')
                 break
-            bronze = [x for x in self.fme.session().tradepile() if x['rating'] <= 64]
+            bronze = [x for x in self.fme.tm.tradepile.all() if x['rating'] <= 64]
             if len(bronze) >= 70:
                 logger.warning('%s bronze cards listed. Not buying new packs.', len(bronze))
                 break
@@ -45,16 +45,18 @@ class Proc(object):
 
     def refresh_tradepile(self):
         # handle sold and expired items
-        tradepile = self.fme.session().tradepile()
-        sold = [x for x in tradepile if x['tradeState'] == 'closed']
+        tradepile = self.fme.tm.tradepile
+        sold = tradepile.closed()
         if sold:
             sale = sum([x['currentBid'] for x in sold])
             logger.info('%s items sold for a total of %s coins. Clear=%s',
                         len(sold), sale, self.fme.session().tradepileClear())
+            tradepile.cleared()
 
-        expired = [x for x in tradepile if x['tradeState'] == 'expired']
+        expired = tradepile.expired()
         if expired:
             relisted = self.fme.session().relist()['tradeIdList']
+            tradepile.relisted()
             logger.info('%s items listing expired. Relist=%s', len(expired), len(relisted))
 
     def pack(self):
@@ -92,6 +94,7 @@ class Proc(object):
 
         if keep:
             self.fme.session().sendToClub(keep)
+            self.fme.club.snapshot.added([c for c in unassigned if c['id'] in keep])
         if discard:
             self.fme.session().quickSell(discard)
         for id in redeem:
@@ -145,12 +148,12 @@ class Proc(object):
 
     def sell_excess_consumables(self):
         # check room on transfer list
-        vacancy = self.fme.session().tradepile_size - len(self.fme.session().tradepile())
+        vacancy = self.fme.session().tradepile_size - len(self.fme.tm.tradepile)
         if vacancy < 15:
             return
-        # cards = [x for x in self.fme.session().tradepile() if x['resourceId'] == 5002006]
-        # cards = [x for x in self.fme.session().tradepile() if x['resourceId'] == 5002001]
-        cards = [x for x in self.fme.session().tradepile() if x['resourceId'] == 5002003]
+        # cards = self.fme.tm.tradepile.by_rid(5002006)
+        # cards = self.fme.tm.tradepile.by_rid(5002001)
+        cards = self.fme.tm.tradepile.by_rid(5002003)
         if len(cards) >= 10:
             return
         # self.fme.tm.sell_consumable(5002006, 1300)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import Mapping
+
+logger = logging.getLogger(__name__)
+
+class PlayerSnapshot(Mapping):
+    '''Read-only map of assetId -> player definition backed by a memory-mapped file
+
+    File layout (native byte order - it is a local cache, not an exchange format):
+    - header: magic, version, count
+    - ids: count sorted uint32 asset ids
+    - offsets: count+1 uint32 offsets into the records blob
+    - records: utf-8 'firstname<US>lastname<US>surname<US>rating' per player
+
+    These are all the fields fut.core.players() has, so a player comes back the same as
+    it went in. Any other fields given to write() are not kept.
+    '''
+
+    _MAGIC = b'FMPS'
+    _VERSION = 1
+    _HEADER = struct.Struct('=4sII')
+    _SEP = u'\x1f'
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = PlayerSnapshot._HEADER.unpack_from(self._mm, 0)
+        if magic != PlayerSnapshot._MAGIC or version != PlayerSnapshot._VERSION:
+            self._mm.close()
+            raise ValueError('Not a player snapshot (version {}): {}'.format(PlayerSnapshot._VERSION, path))
+        start = PlayerSnapshot._HEADER.size
+        view = memoryview(self._mm)
+        self._ids = view[start:start + 4 * count].cast('I')
+        start += 4 * count
+        self._offsets = view[start:start + 4 * (count + 1)].cast('I')
+        self._records = start + 4 * (count + 1)
+
+    def __getitem__(self, asset_id):
+        i = bisect.bisect_left(self._ids, asset_id)
+        if i == len(self._ids) or self._ids[i] != asset_id:
+            raise KeyError(asset_id)
+        return self._decode(i)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _decode(self, i):
+        start, end = self._records + self._offsets[i], self._records + self._offsets[i+1]
+        firstname, lastname, surname, rating = self._mm[start:end].decode('utf-8').split(PlayerSnapshot._SEP)
+        return {'id': self._ids[i],
+                'firstname': firstname,
+                'lastname': lastname,
+                'surname': surname if surname else None,
+                'rating': int(rating)}
+
+    @staticmethod
+    def write(path, players):
+        '''Write players (a dict of assetId -> player definition) to a snapshot file
+
+        The file is written to a temp file first and renamed into place, so readers
+        never see a partial snapshot.
+        '''
+        ids = array('I', sorted(players))
+        offsets = array('I', [0])
+        records = bytearray()
+        for asset_id in ids:
+            p = players[asset_id]
+            rec = PlayerSnapshot._SEP.join([p['firstname'], p['lastname'], p['surname'] or u'', str(p['rating'])])
+            records += rec.encode('utf-8')
+            offsets.append(len(records))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(PlayerSnapshot._HEADER.pack(PlayerSnapshot._MAGIC, PlayerSnapshot._VERSION, len(ids)))
+            f.write(ids.tobytes())
+            f.write(offsets.tobytes())
+            f.write(records)
+        os.replace(tmp_path, path)
+        logger.info('Saved %s players to snapshot %s', len(ids), path)
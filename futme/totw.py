@@ -3,7 +3,7 @@
 import logging
 import re
 
-import requests
+from . import httpclient
 
 logger = logging.getLogger(__name__)
 
@@ -16,11 +16,11 @@ TOTW_PAGE_PATH='/19/totw/totw{}/'
 
 def totw(week):
     page_url = FH_BASE_URL + TOTW_PAGE_PATH.format(week)
-    html = requests.get(page_url).text
+    html = httpclient.get(page_url).text
     p = re.compile('"apiRetrievalUrl": "(.*?)"')
     m = p.search(html)
     api_url = FH_BASE_URL + m.group(1)
-    data = requests.get(api_url).json()
+    data = httpclient.get_json(api_url)
     result = [_convert(x['data']) for x in data['players']]
     return sorted(result, key=lambda x: x['rating'], reverse=True)
 
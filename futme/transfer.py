@@ -1,22 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
 import traceback
 import time
 from collections import Counter
 
 import fut
-from beaker.cache import cache_region, cache_regions, region_invalidate
+from beaker.cache import cache_region, cache_regions
 
-from . import core, price, util, timeutil
+from . import analytics, core, market, price, util, timeutil
 
 logger = logging.getLogger(__name__)
 
 cache_regions.update({
-    'transfer_tradepile':{
-        'expire': 10,
-        'type': 'memory'
-    },
     'transfer_market_price':{
         'expire': 600,
         'type': 'memory'
@@ -29,8 +26,17 @@ class TransferMarket(object):
 
     def __init__(self, fme):
         self.fme = fme
-        self.tradepile = Tradepile(fme)
+        self.tradepile = TradepileIndex(fme)
         self.failed_bids = set()
+        # failed_bids and search_stats are shared by all traders, which may run in threads
+        # (see aio). buys (and market price lookups) of the same card are made one at a time
+        self._lock = threading.Lock()
+        self._locks = {}
+        # searches used by search_min_price: lookups, searches, resolved, capped, and
+        # observed (settled by market observations without searching)
+        self.search_stats = Counter()
+        # rid -> the min price its last lookup found, the first guess of the next one
+        self.last_min_prices = {}
 
     def tradepile_cleanup_targets(self, keep_all_above_rating=83, sell_all_below_rating=75):
         a = self.tradepile.inactive()
@@ -68,16 +74,16 @@ class TransferMarket(object):
         if search_mkt_price:
             append = 'mp={} ' + append
         sfmt = self.fme.disp.format(players, append=append)
+        q_prcs = price.quick_many(players)
+        stats = analytics.price_table(players) if inc_history else None
         for p in players:
-            q_prc = price.quick(p)
+            q_prc = q_prcs[p['resourceId']]
             args = [q_prc]
             if inc_history:
-                phist = price.history(p)
-                ph7d, ph30d, ph90d = phist.slice(7), phist.slice(30), phist.slice(90)
-                phist_str = 'hl7d={}/{} hl30d={}/{} hl90d={}/{}'.format(
-                    ph7d.high().value, ph7d.low().value,
-                    ph30d.high().value, ph30d.low().value,
-                    ph90d.high().value, ph90d.low().value)
+                s = lambda name: stats.fmt(p['resourceId'], name)
+                phist_str = 'hl7d={}/{} hl30d={}/{} hl90d={}/{} vol30d={}% tr30d={}%'.format(
+                    s('hi7d'), s('lo7d'), s('hi30d'), s('lo30d'), s('hi90d'), s('lo90d'),
+                    s('vol30d'), s('trend30d'))
                 args.append(phist_str)
             if search_mkt_price:
                 mkt_prc = self.get_market_price_cached(p)
@@ -89,18 +95,22 @@ class TransferMarket(object):
         append += ' mp={:5}' if search_mkt_price else ' qp={:5}'
         append += ' pr={:5} {}'
         sfmt = self.fme.disp.format(players, append=append)
+        if search_mkt_price:
+            prcs = {p['resourceId']: self.get_market_price_cached(p) for p in players}
+        else:
+            prcs = price.quick_many(players)
+        stats = analytics.price_table(players, prcs)
         for p in players:
             tenure = timeutil.dur_days(time.time() - p['timestamp'])
-            prc = self.get_market_price_cached(p) if search_mkt_price else price.quick(p)
-            phist = price.history(p)
-            tscore = phist.trade_score(prc)
+            prc = prcs[p['resourceId']]
+            tscore = stats.fmt(p['resourceId'], 'ts')
             lsp = p['lastSalePrice']
             profit = prc - lsp
             profit_pct = 'all' if lsp == 0 else str(int(profit * 100.0/lsp)) + '%'
             logging.info(self.fme.disp.sprint(sfmt, p, tenure, tscore, prc, profit, profit_pct))
 
     def relist_expired(self, rid, max_buy=None):
-        players = [x for x in self.tradepile.expired() if x['resourceId'] == rid]
+        players = self.tradepile.by_rid(rid, ['expired'])
         if not players:
             logger.warn('No expired listing for rid=%s', rid)
             return
@@ -113,7 +123,7 @@ class TransferMarket(object):
 
 
     def relist_all_expired(self, rids):
-        players = [x for x in self.tradepile.expired() if x['resourceId'] in rids]
+        players = util.psorted([x for rid in set(rids) for x in self.tradepile.by_rid(rid, ['expired'])])
         if not players:
             logger.warn('No expired listing for rids: %s', rids)
             return
@@ -124,7 +134,7 @@ class TransferMarket(object):
             self.sell(p, mkt_prc)
             logger.info(self.fme.disp.sprint(sfmt, p, mkt_prc))
 
-    def search_min_price(self, player, seen_prices=3):
+    def search_min_price(self, player, seen_prices=3, max_searches=8):
         mkt_min, mkt_max = price.MIN_PRICE, price.MAX_PRICE
         if isinstance(player, int):
             rid = player
@@ -141,65 +151,106 @@ class TransferMarket(object):
                 logger.info(player)
 
         session = self.fme.session()
+        ladder = price.LADDER
         current_player = None
         current = mkt_max
-        # use quick price as initial attempt
-        attempt = price.quick(rid)
-        failed_attempt = mkt_min
-        seen = {}
-        # XXX cap the number of iterations in case there is a bug to cause infinite loop...
-        for i in range(8):
-            logger.debug('round %s: current=%s, attempt=%s, failed_attempt=%s',
-                         i, current, attempt, failed_attempt)
-            # if current low is just one step above hard min or last failed attempt, we are done
-            if current == price.pincrement(mkt_min) or current <= price.pincrement(failed_attempt):
-                logger.debug('break - current is the lowest possible')
-                break
+        # bisect over tick indexes of the price ladder. the min price is known to be in (lo, hi]:
+        # nothing is listed at or below lo, and hi is the lowest listing found so far (or one
+        # past mkt_max until we have found one)
+        lo, hi = ladder.index(mkt_min) - 1, ladder.index(mkt_max) + 1
+        # fresh observations from earlier searches (ours or another trader's) may already
+        # narrow down the bracket, or even settle it without searching at all
+        observed = market.observations.listings(rid)
+        maybe_player, maybe_price = _sticky_min(observed)
+        if maybe_player is not None and maybe_price <= mkt_max:
+            current_player, current = maybe_player, maybe_price
+            hi = ladder.index(current)
+        floor = market.observations.floor(rid)
+        if floor is not None:
+            if current_player is not None and current <= floor:
+                # a complete search saw everything up to floor, and current is the lowest of it
+                lo = hi - 1
+            else:
+                lo = max(lo, ladder.index(floor))
+        attempt = self._seed_price(rid, mkt_min, mkt_max)
+        if not lo < ladder.index(attempt) < hi:
+            attempt = ladder.price_at((lo + hi) // 2)
+        # gallop away from the seed (1, 2, 4... ticks) as long as the results keep pointing the
+        # same way - the seed is usually close to the min price. bisect once they don't
+        direction, gallop = 0, 1
+        searches = 0
+        seen = {x['id']: x for x in observed}
+        while hi - lo > 1 and searches < max_searches:
+            logger.debug('search %s: lo=%s, hi=%s, attempt=%s',
+                         searches, ladder.price_at(lo), current, attempt)
             search_result = session.search('player', defId=rid, max_buy=attempt)
+            searches += 1
+            market.observations.record(rid, attempt, search_result, TransferMarket._SEARCH_PAGE_SIZE)
             for x in search_result:
                 seen[x['id']] = x
             logger.debug('search returned %s items (%s)',
                          len(search_result),
                          [(x['buyNowPrice'], x['expires']) for x in search_result])
-            if not search_result:
-                if attempt == mkt_max:
+            maybe_player, maybe_price = _sticky_min(search_result)
+            if maybe_player is None:
+                # nothing (or only brand new listings) returned - attempt price is too low
+                if attempt >= mkt_max:
                     logger.debug('break - nothing on market')
                     break
-                else:
-                    # nothing returned - attempt price is too low. record the failed attempt, and
-                    # set new attempt price to be closer to the current low
-                    failed_attempt = attempt
-                    attempt = price.pround((failed_attempt + current)/2)
-            elif len(search_result) < TransferMarket._SEARCH_PAGE_SIZE:
-                # if search returned less than the full page, return the min value
-                maybe_player, maybe_price = _sticky_min(search_result)
-                if maybe_player is not None:
-                    current_player = maybe_player
-                    current = maybe_price
+                lo, move = ladder.index(attempt), 1
+            else:
+                current_player, current = maybe_player, maybe_price
+                hi, move = ladder.index(current), -1
+                if len(search_result) < TransferMarket._SEARCH_PAGE_SIZE:
+                    # if search returned less than the full page, we have seen the min value
                     logger.debug('break - found min price (search result is less than full page)')
                     break
-                else:
-                    failed_attempt = attempt
-                    attempt = price.pround((failed_attempt + current)/2)
+
+            mid = (lo + hi) // 2
+            if direction in (0, move):
+                direction = move
+                nxt = min(lo + gallop, mid) if move > 0 else max(hi - gallop, mid)
+                gallop *= 2
             else:
-                # full page returned. set new attemp price to be between previous
-                # failed attemp and current low
-                maybe_player, maybe_price = _sticky_min(search_result)
-                if maybe_player is not None:
-                    current_player = maybe_player
-                    current = maybe_price
-                    attempt = price.pround((failed_attempt + current)/2)
-                else:
-                    failed_attempt = attempt
-                    attempt = price.pround((failed_attempt + current)/2)
+                direction, nxt = None, mid
+            attempt = ladder.price_at(nxt)
+
+        with self._lock:
+            self.search_stats['lookups'] += 1
+            self.search_stats['searches'] += searches
+            if current_player is not None:
+                self.search_stats['resolved'] += 1
+                self.last_min_prices[rid] = current
+            if hi - lo > 1 and searches >= max_searches:
+                self.search_stats['capped'] += 1
+            if searches == 0:
+                self.search_stats['observed'] += 1
+        logger.debug('rid %s: min price %s after %s searches', rid, current, searches)
+        if current_player is not None and searches > 0:
+            price.record_market_price(rid, current)
 
         seen = sorted(seen.values(), key=lambda x: x['buyNowPrice'])
         seen = [(x['buyNowPrice'], x['expires']) for x in seen]
         return (current_player, current, seen if seen_prices is None else seen[:seen_prices])
 
+    def _seed_price(self, rid, mkt_min, mkt_max):
+        # runs before every lookup, so only from what is in memory - no futbin request or
+        # price store. the min price of our last lookup is the best first guess, then the
+        # cached futbin price. without either the middle of the market range does as well
+        with self._lock:
+            seed = self.last_min_prices.get(rid)
+        if seed is None or not mkt_min < seed <= mkt_max:
+            seed = price.quick_cached(rid)
+        if seed is None or not mkt_min < seed <= mkt_max:
+            seed = price.LADDER.midpoint(mkt_min, mkt_max)
+        return price.pround(seed)
+
     def get_market_price_cached(self, player):
         rid = player if isinstance(player, int) else player['resourceId']
-        return self._get_market_price_cached(rid)
+        # one lookup at a time: its FUT calls are serialized anyway, and this keeps the
+        # beaker region from being filled by two threads at once
+        with self._lock_for(('price', rid)):
+            return self._get_market_price_cached(rid)
 
     @cache_region('transfer_market_price', 'get_market_price')
     def _get_market_price_cached(self, player):
@@ -228,13 +279,17 @@ class TransferMarket(object):
 
         session = self.fme.session()
         if send_to_tradepile_first:
-            if session.sendToTradepile(item_id):
-                return session.sell(item_id, starting_bid, buy_now)
-            else:
+            if not session.sendToTradepile(item_id):
                 logger.warning('Failed to send item to tradepile. Abort selling item %s', item)
                 return None
-        else:
-            return session.sell(item_id, starting_bid, buy_now)
+            if isinstance(item, dict):
+                self.tradepile.put(item)
+            else:
+                self.tradepile.invalidate()
+            self.fme.club.snapshot.removed([item_id])
+        trade_id = session.sell(item_id, starting_bid, buy_now)
+        self.tradepile.listed(item_id, trade_id, starting_bid, buy_now)
+        return trade_id
 
 
     def sell_all(self, items, price_check=lambda x: True):
@@ -250,9 +305,13 @@ class TransferMarket(object):
         session = self.fme.session()
         card = next(x for x in session.clubConsumables() if x['resourceId'] == rid)
         session.sendToTradepile(card['id'])
-        card = next(x for x in self.fme.tm.tradepile.inactive() if x['resourceId'] == rid)
+        # the tradepile item of a consumable is not the club one. look it up with a fresh sync
+        self.tradepile.invalidate()
+        card = self.tradepile.by_rid(rid, [None])[0]
         starting_bid = price.pincrement(buy_now, steps=-1)
-        return session.sell(card['id'], starting_bid, buy_now)
+        trade_id = session.sell(card['id'], starting_bid, buy_now)
+        self.tradepile.listed(card['id'], trade_id, starting_bid, buy_now)
+        return trade_id
 
     def buy_hunter_style(self, max_buy):
         return self.buy_play_style(max_buy, 266)
@@ -261,12 +320,18 @@ class TransferMarket(object):
         return self.buy_play_style(max_buy, 268)
 
     def buy_play_style(self, max_buy, subtypeid):
+        with self._lock_for(('playStyle', subtypeid)):
+            return self._buy_play_style(max_buy, subtypeid)
+
+    def _buy_play_style(self, max_buy, subtypeid):
         session = self.fme.session()
         failed_bid_attempts = 0
         while failed_bid_attempts < 3:
             for_sale = session.search('training', category='playStyle', playStyle=subtypeid, max_buy=max_buy)
+            market.observations.record(None, max_buy, for_sale, TransferMarket._SEARCH_PAGE_SIZE)
             # removed items we bid on but failed
-            for_sale = [x for x in for_sale if x['id'] not in self.failed_bids]
+            with self._lock:
+                for_sale = [x for x in for_sale if x['id'] not in self.failed_bids]
             for_sale.sort(key=lambda x: x['buyNowPrice'])
             if for_sale:
                 # retry if we found items but bid failed
@@ -280,28 +345,55 @@ class TransferMarket(object):
                         won = False
                         logger.error('Bid failed - NoTradeExistingError')
                     logger.info(self.fme.disp.sprint(sfmt, p, bid, won))
+                    # the listing is gone either way
+                    market.observations.remove(p['resourceId'], p['tradeId'])
                     if won:
                         return p
                     # record failed items to avoid retrying on them
-                    self.failed_bids.add(p['id'])
+                    with self._lock:
+                        self.failed_bids.add(p['id'])
                 failed_bid_attempts += 1
             else:
                 # quit if we didn't find anything
                 break
         return None
 
-    def buy_now(self, resource_id, max_buy):
+    def buy_now(self, resource_id, max_buy, observer=None):
+        '''Buys the cheapest resource_id listed at max_buy or less, if any
+
+        :param observer: (optional) the trader buying. Its own earlier searches never make
+            it skip one (see market.MarketObservations.nothing_below)
+        '''
         if max_buy <= 0:
             logging.error('There is a bug! max_buy passed to buy_now() is %s for rid %s',
                           max_buy, resource_id)
             return None
-
+        # two traders of the same card take turns: the second one sees the listings the
+        # first one took (or failed to) as gone
+        with self._lock_for(('buy', resource_id)):
+            return self._buy_now(resource_id, max_buy, observer)
+
+    def _lock_for(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _buy_now(self, resource_id, max_buy, observer):
         session = self.fme.session()
         failed_bid_attempts = 0
         while failed_bid_attempts < 3:
+            # skip the search if another lookup has just seen there is nothing at this price
+            if failed_bid_attempts == 0 and market.observations.nothing_below(resource_id, max_buy,
+                                                                               observer=observer):
+                logger.debug('Nothing (rid=%s) at %s or less on market just now', resource_id, max_buy)
+                break
             for_sale = session.search('player', defId=resource_id, max_buy=max_buy)
+            market.observations.record(resource_id, max_buy, for_sale, TransferMarket._SEARCH_PAGE_SIZE,
+                                       observer)
             # removed items we bid on but failed
-            for_sale = [x for x in for_sale if x['id'] not in self.failed_bids]
+            with self._lock:
+                for_sale = [x for x in for_sale if x['id'] not in self.failed_bids]
             for_sale.sort(key=lambda x: x['buyNowPrice'])
             if for_sale:
                 # retry if we found items but bid failed
@@ -316,10 +408,13 @@ class TransferMarket(object):
                         won = False
                         logger.error('Bid failed - NoTradeExistingError')
                     logger.info(self.fme.disp.sprint(sfmt, p, bid, won))
+                    # the listing is gone either way
+                    market.observations.remove(p['resourceId'], p['tradeId'])
                     if won:
                         return p
                     # record failed items to avoid retrying on them
-                    self.failed_bids.add(p['id'])
+                    with self._lock:
+                        self.failed_bids.add(p['id'])
                 failed_bid_attempts += 1
             else:
                 # quit if we didn't find anything
@@ -338,10 +433,35 @@ def _sticky_min(search_result):
             player, min_price = x, buy_now
     return player, min_price
 
-class Tradepile(object):
+class TradepileIndex(object):
+    '''The tradepile, indexed by tradeState and by resourceId
 
-    def __init__(self, fme):
+    Reads sync with the server at most every max_age seconds: a fresh tradepile() snapshot is
+    diff-merged into the index (items added, changed and gone). In between, our own sell,
+    relist, clear and sendToTradepile calls are applied locally, so that the index reflects
+    them without another snapshot. Items sold or expired on the server only show up with the
+    next snapshot, same as with any cache.
+
+    Safe to use from multiple threads.
+    '''
+
+    def __init__(self, fme, max_age=10):
         self.fme = fme
+        self.max_age = max_age
+        self.synced_at = None
+        # snapshots merged, and the items they added, changed and removed
+        self.stats = Counter()
+        self._lock = threading.RLock()
+        self._items = {}
+        self._by_state = {}
+        self._by_rid = {}
+        # psorted lists by state (and None -> all), until the next change
+        self._sorted = {}
+
+    def __len__(self):
+        with self._lock:
+            self.sync()
+            return len(self._items)
 
     def expired(self):
         return self.filter_by_state('expired')
@@ -356,26 +476,118 @@ class Tradepile(object):
         return self.filter_by_state(None)
 
     def filter_by_state(self, trade_state):
-        return [x for x in self.all() if x['tradeState'] == trade_state]
+        with self._lock:
+            self.sync()
+            key = ('state', trade_state)
+            if key not in self._sorted:
+                self._sorted[key] = util.psorted(self._by_state.get(trade_state, {}).values())
+            return list(self._sorted[key])
 
     def group_by_state(self):
-        d = {}
-        for x in self.all():
-            ts = x['tradeState']
-            l = d.get(ts, [])
-            l.append(x)
-            d[ts] = l
-        return d
-
-    @cache_region('transfer_tradepile', 'all')
+        with self._lock:
+            self.sync()
+            return {ts: self.filter_by_state(ts) for ts in self._by_state if self._by_state[ts]}
+
+    def by_rid(self, rid, states=None):
+        '''Items of rid, in any of states (a list of tradeStates) if given'''
+        with self._lock:
+            self.sync()
+            items = self._by_rid.get(rid, {}).values()
+            return util.psorted([x for x in items if states is None or x['tradeState'] in states])
+
     def all(self):
-        tp = self.fme.session().tradepile()
-        return util.psorted(tp)
+        with self._lock:
+            self.sync()
+            if 'all' not in self._sorted:
+                self._sorted['all'] = util.psorted(self._items.values())
+            return list(self._sorted['all'])
 
     def refresh(self):
-        region_invalidate(self.all, 'transfer_tradepile', 'all')
+        self.sync(force=True)
         return self.all()
 
+    def sync(self, force=False):
+        with self._lock:
+            if force or self._stale():
+                self.merge(self.fme.session().tradepile())
+
+    def invalidate(self):
+        '''The next read syncs, e.g. after a call whose effect we cannot apply locally'''
+        with self._lock:
+            self.synced_at = None
+
+    def merge(self, snapshot):
+        '''Brings the index in line with snapshot, a full tradepile() result'''
+        with self._lock:
+            fresh = {x['id']: x for x in snapshot}
+            for item_id in [k for k in self._items if k not in fresh]:
+                self._remove(item_id)
+                self.stats['removed'] += 1
+            for item_id, x in fresh.items():
+                current = self._items.get(item_id)
+                if current is None:
+                    self._add(x)
+                    self.stats['added'] += 1
+                elif current != x:
+                    self._remove(item_id)
+                    self._add(x)
+                    self.stats['changed'] += 1
+            self.stats['syncs'] += 1
+            self.synced_at = time.time()
+
+    # local updates after our own calls
+
+    def put(self, item):
+        '''item was sent to the tradepile'''
+        with self._lock:
+            self._remove(item['id'])
+            self._add(dict(item, pile=5, tradeId=0, tradeState=None, buyNowPrice=0, expires=0))
+
+    def listed(self, item_id, trade_id, starting_bid, buy_now, duration=3600):
+        with self._lock:
+            if item_id not in self._items:
+                self.invalidate()
+                return
+            item = self._remove(item_id)
+            item.update({'tradeId': trade_id, 'tradeState': 'active', 'startingBid': starting_bid,
+                         'buyNowPrice': buy_now, 'currentBid': 0, 'expires': duration})
+            self._add(item)
+
+    def relisted(self, duration=3600):
+        '''All expired items were relisted at their last prices'''
+        with self._lock:
+            for item_id in list(self._by_state.get('expired', {})):
+                item = self._remove(item_id)
+                item.update({'tradeState': 'active', 'expires': duration})
+                self._add(item)
+
+    def cleared(self):
+        '''The sold items were cleared'''
+        with self._lock:
+            for item_id in list(self._by_state.get('closed', {})):
+                self._remove(item_id)
+
+    def _stale(self):
+        return self.synced_at is None or time.time() - self.synced_at >= self.max_age
+
+    def _add(self, item):
+        # items are copied in, so that callers can not change the index behind its back
+        item = dict(item)
+        self._items[item['id']] = item
+        self._by_state.setdefault(item['tradeState'], {})[item['id']] = item
+        self._by_rid.setdefault(item['resourceId'], {})[item['id']] = item
+        self._sorted = {}
+
+    def _remove(self, item_id):
+        item = self._items.pop(item_id, None)
+        if item is not None:
+            del self._by_state[item['tradeState']][item_id]
+            del self._by_rid[item['resourceId']][item_id]
+            if not self._by_rid[item['resourceId']]:
+                del self._by_rid[item['resourceId']]
+            self._sorted = {}
+        return item
+
 def main():
     logging.basicConfig(
         format='%(asctime)s %(levelname)-8s %(message)s',
@@ -383,7 +595,7 @@ def main():
         level=logging.INFO)
 
     fme = core.Futme()
-    tp = Tradepile(fme)
+    tp = TradepileIndex(fme)
     logger.info('inactive=%s, active=%s, expired=%s, closed=%s',
                 len(tp.inactive()), len(tp.active()), len(tp.expired()), len(tp.closed()))
 
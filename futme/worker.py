@@ -1,44 +1,194 @@
 # -*- coding: utf-8 -*-
 
+import heapq
+import itertools
 import logging
 import time
 
+from . import governor, metrics
+
 logger = logging.getLogger(__name__)
 
 class LoopyWorker:
 
-    def __init__(self):
+    def __init__(self, scheduler=None):
         self.tasks = []
+        self.scheduler = scheduler
+        self.paused = False
+        self.stats = TaskStats()
 
     def register_task(self, task_name, func, interval, delay=0):
-        self.tasks.append(LoopyTask(task_name, func, interval, delay))
+        task = LoopyTask(task_name, func, interval, delay, worker=self)
+        self.tasks.append(task)
+        if self.scheduler is not None:
+            self.scheduler.add(task)
+
+    def unregister_all(self):
+        if self.scheduler is not None:
+            for t in self.tasks:
+                self.scheduler.remove(t)
+        self.tasks = []
 
     def run(self):
+        if self.paused:
+            return
         for t in self.tasks:
             t.run()
 
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            # tasks that became due while paused run right away, same as with run()
+            if self.scheduler is not None:
+                for t in self.tasks:
+                    self.scheduler.reschedule(t)
+
     def set_task_interval(self, task_name, new_value):
-        return [t.set_interval(new_value) for t in self.tasks if t.name == task_name]
+        result = []
+        for t in self.tasks:
+            if t.name == task_name:
+                result.append(t.set_interval(new_value))
+                if self.scheduler is not None:
+                    self.scheduler.reschedule(t)
+        return result
 
 
 class LoopyTask:
 
-    def __init__(self, name, func, interval, delay):
+    def __init__(self, name, func, interval, delay, worker=None):
         self.name = name
         self.func = func
         self.interval = interval
+        self.worker = worker
         self.last_execution_time = 0 if delay == 0 else time.time() - interval + delay
 
     def run(self):
         if time.time() - self.last_execution_time > self.interval:
-            self.func()
-            self.last_execution_time = time.time()
+            self.execute()
+
+    def execute(self):
+        start = time.time()
+        # how late the task is running. not meaningful for the first run
+        lag = start - self.next_run_time() if self.last_execution_time > 0 else 0
+        try:
+            with metrics.registry.timed('task', self.name):
+                self.func()
+        except governor.Throttled as e:
+            # over the FUT call budget. try again next interval
+            logger.warning('Task %s skipped: %s', self.name, e)
+        self.last_execution_time = time.time()
+        if self.worker is not None:
+            self.worker.stats.record(self.last_execution_time - start, max(lag, 0))
+
+    def next_run_time(self):
+        return self.last_execution_time + self.interval
 
     def set_interval(self, new_value):
         old_value, self.interval = self.interval, new_value
         return old_value
 
 
+class TaskStats:
+    '''Run time and lag (how long after it was due a task started) of a worker's tasks'''
+
+    def __init__(self):
+        self.runs = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def record(self, duration, lag):
+        self.runs += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def mean_time(self):
+        return self.total_time / self.runs if self.runs else 0
+
+    def mean_lag(self):
+        return self.total_lag / self.runs if self.runs else 0
+
+    def __str__(self):
+        return 'runs={} time={:.1f}/{:.1f}s lag={:.1f}/{:.1f}s'.format(
+            self.runs, self.mean_time(), self.max_time, self.mean_lag(), self.max_lag)
+
+
+class Scheduler:
+    '''Runs the tasks of any number of LoopyWorkers, each when it is due
+
+    Tasks are kept in a heap ordered by next run time, so run_pending() only looks at
+    the tasks that are due, and sleep() sleeps exactly until the next one is.
+
+    scheduler = Scheduler()
+    w1, w2 = LoopyWorker(scheduler), LoopyWorker(scheduler)
+    w1.register_task('t1', func1, 5)
+    w2.register_task('t2', func2, 2)
+    while True:
+        scheduler.run_pending()
+        scheduler.sleep()
+    '''
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        # task -> its live heap entry. replaced entries stay in the heap, marked with a
+        # None task, and are skipped when they come up
+        self._entries = {}
+
+    def add(self, task, run_time=None):
+        if task in self._entries:
+            self._entries[task][2] = None
+        entry = [task.next_run_time() if run_time is None else run_time, next(self._seq), task]
+        self._entries[task] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, task):
+        entry = self._entries.pop(task, None)
+        if entry is not None:
+            entry[2] = None
+
+    def reschedule(self, task):
+        if task in self._entries:
+            self.add(task)
+
+    def next_run_time(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def run_pending(self):
+        now = time.time()
+        while True:
+            next_run_time = self.next_run_time()
+            if next_run_time is None or next_run_time > now:
+                break
+            entry = heapq.heappop(self._heap)
+            task = entry[2]
+            if task.worker is not None and task.worker.paused:
+                # check back in an interval. resume() brings it forward again
+                self.add(task, time.time() + task.interval)
+                continue
+            try:
+                task.execute()
+            finally:
+                # queue it up again, also when it raised, unless it was removed or
+                # rescheduled while running
+                if self._entries.get(task) is entry:
+                    self.add(task)
+
+    def sleep(self, max_seconds=60):
+        next_run_time = self.next_run_time()
+        delay = max_seconds if next_run_time is None else min(next_run_time - time.time(), max_seconds)
+        if delay > 0:
+            time.sleep(delay)
+
+
 def main():
     logging.basicConfig(
         format='%(asctime)s %(levelname)-8s %(message)s',
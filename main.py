@@ -5,8 +5,10 @@ import sys
 import time
 from random import randint
 
+import futme.analytics as analytics
 import futme.core as core
 import futme.display as display
+import futme.governor as governor
 import futme.price as price
 import futme.timeutil as timeutil
 import futme.totw as totw
@@ -34,9 +36,11 @@ def main():
         print('  main.py cleanup_tradepile')
         print('  main.py dump_club_players gold|silver|bronze')
         print('  main.py dump_expandables')
+        print('  main.py dump_club_prices gold|silver|bronze')
         print('  main.py totw <week>')
         print('  main.py sms <message>')
         print('  main.py sbc <fbids>')
+        print('  main.py players <name>')
         return
 
     if len(sys.argv) > 1:
@@ -53,9 +57,18 @@ def main():
             fme.tm.price_players(fme.tm.tradepile.inactive())
         elif cmd == 'dump_club_players':
             level = sys.argv[2]
+            # the snapshot may be up to an hour old, or from another process. dumps are of the club now
+            fme.club.snapshot.sync(force=True)
             p = fme.club.all_players(level=level)
             datafile.dump_players(p, 'futme_club_all_players_' + level, fme)
+        elif cmd == 'dump_club_prices':
+            level = sys.argv[2]
+            fme.club.snapshot.sync(force=True)
+            p = fme.club.all_players(level=level)
+            table = analytics.price_table(p, price.quick_many(p))
+            datafile.save_tsv(table.to_rows(), 'futme_club_prices_' + level + '.tsv')
         elif cmd == 'dump_expandables':
+            fme.club.snapshot.sync(force=True)
             p = fme.club.expandables()
             datafile.dump_players(p, 'futme_club_expandables', fme)
         elif cmd == 'totw':
@@ -66,6 +79,10 @@ def main():
         elif cmd == 'sbc':
             fbids = sys.argv[2].split(',')
             print_sbc_buyer_configs(fme, fbids)
+        elif cmd == 'players':
+            for p in fme.lu.find_players(' '.join(sys.argv[2:])):
+                print(u'{:>8}  {:>2}  {} {} ({})'.format(
+                    p['id'], p['rating'], p['firstname'], p['lastname'], display.none_str(p['surname'])))
         else:
             logger.error('invalid command: %s', sys.argv[1:])
     else:
@@ -77,17 +94,18 @@ def totw_prices():
     players = fme.club.special(rareflags=[3])
     players = [p for p in players if not p['untradeable']]
     sfmt = fme.disp.format(players, append='{}')
+    est_prices = price.quick_many(players)
+    stats = analytics.price_table(players)
     def proc(p):
         tenure = timeutil.dur_days(time.time() - p['timestamp'])
         bought_for = p['lastSalePrice']
-        est_price = price.quick(p)
+        est_price = est_prices[p['resourceId']]
         incr = est_price - bought_for
         incr_pct = str(int(incr*100.0/bought_for)) + '%' if bought_for > 0 else 'INF'
         profit = int(incr - est_price * 0.05)
-        h = price.history(p)
-        h7d = h.slice(7)
-        h30d = h.slice(30)
-        h_str = 'hilo: 1wk={}/{} 1mo={}/{}'.format(h7d.high(), h7d.low(), h30d.high(), h30d.low())
+        stat = lambda name: stats.fmt(p['resourceId'], name)
+        h_str = 'hilo: 1wk={}/{} 1mo={}/{} tr30d={}%'.format(
+            stat('hi7d'), stat('lo7d'), stat('hi30d'), stat('lo30d'), stat('trend30d'))
         s = 'sl={:>2}d mp={:<5} in={:<4} pf={} {}'.format(
             tenure, est_price, incr_pct, profit, h_str)
         return (p, profit, s)
@@ -100,4 +118,10 @@ def totw_prices():
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except governor.Throttled as e:
+        # outside of the autopilot's tasks, nothing retries a call the governor gave up on
+        logger.error('Gave up waiting for the FUT rate budget: %s', e)
+        fme.shutdown()
+        sys.exit(1)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from futme import autotrader, backtest, datafile, price, pricestore
+
+
+class DecisionTest(unittest.TestCase):
+    '''The Buyer and Flipper decisions the backtest replays'''
+
+    def test_flex_bid(self):
+        self.assertEqual(autotrader.flex_bid(1000, 0.9, 0, 0), 900)
+        # capped by the suggested bid, but not raised to it
+        self.assertEqual(autotrader.flex_bid(1000, 0.9, 800, 0), 800)
+        self.assertEqual(autotrader.flex_bid(1000, 0.9, 5000, 0), 900)
+        # never at or below the discard value
+        self.assertEqual(autotrader.flex_bid(1000, 0.5, 0, 600), 650)
+        self.assertEqual(autotrader.flex_bid(100, 0.5, 0, 60), 100)
+
+    def test_buy_check(self):
+        self.assertIsNone(autotrader.buy_check(900))
+        self.assertEqual(autotrader.buy_check(0), 'nothing in market')
+
+    def test_flip_check(self):
+        self.assertIsNone(autotrader.flip_check(900, 1, 2, 0))
+        self.assertIsNone(autotrader.flip_check(900, 1, 2, 1000))
+        self.assertEqual(autotrader.flip_check(0, 0, 2, 0), 'nothing in market')
+        self.assertEqual(autotrader.flip_check(900, 2, 2, 0), '2 active flips. 2 max')
+        self.assertEqual(autotrader.flip_check(900, 0, 2, 800), 'sellfor (800) is less than bid (900)')
+
+    def test_flip_sell_price(self):
+        self.assertEqual(autotrader.flip_sell_price(0, 1000, 900), 1000)
+        self.assertEqual(autotrader.flip_sell_price(1200, 1000, 900), 1200)
+        # never less than the market price now
+        self.assertEqual(autotrader.flip_sell_price(1200, 1000, 1500), 1500)
+
+
+class BacktestTest(unittest.TestCase):
+
+    def track(self, values, step=600):
+        start = 1500000000
+        return backtest.PriceTrack([start + i * step for i in range(len(values))], values)
+
+    def test_track(self):
+        track = self.track([1000, 1100, 1200])
+        self.assertEqual(track.at(track.start() - 1), 0)
+        self.assertEqual(track.at(track.start() + 599), 1000)
+        self.assertEqual(track.at(track.end()), 1200)
+        self.assertEqual(track.first_at_or_above(1100, track.start(), track.end()), track.start() + 600)
+        self.assertIsNone(track.first_at_or_above(1300, track.start(), track.end()))
+
+    def test_buyer(self):
+        track = self.track([1000] * 100)
+        conf = {'flexbid': True, 'bid': 0, 'discount': 1.0, 'interval': 60, 'quantity': 3}
+        result = backtest.run_buyer(track, conf, spread=0, snipe_loss=0)
+        self.assertEqual(result['bought'], 3)
+        self.assertEqual(result['avg_paid'], 1000)
+        # listings at the market price never go for a discounted bid
+        result = backtest.run_buyer(track, dict(conf, discount=0.9), spread=0, snipe_loss=0)
+        self.assertEqual(result['bought'], 0)
+
+    def test_flipper(self):
+        # bought at the market price, sold once the market has risen past it
+        track = self.track([1000] * 10 + [2000] * 10)
+        conf = {'flexbid': True, 'bid': 0, 'discount': 1.0, 'interval': 60, 'maxflips': 1, 'sellfor': 1500}
+        result = backtest.run_flipper(track, conf, spread=0, snipe_loss=0)
+        self.assertGreaterEqual(result['sold'], 1)
+        self.assertGreater(result['profit'], 0)
+        self.assertLessEqual(result['flips'] - result['sold'], 1)
+
+
+class FromStoreTest(unittest.TestCase):
+    '''A backtest reads the price store as it is, without going to futbin'''
+
+    class NoFutbin(object):
+        def get_json(self, url):
+            raise AssertionError('fetched ' + url)
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.saved = datafile.DB_DIR, price._store, price.futbin_client
+        datafile.DB_DIR = self.db_dir
+        price._store = None
+        price.futbin_client = FromStoreTest.NoFutbin()
+
+    def tearDown(self):
+        price.store().close()
+        datafile.DB_DIR, price._store, price.futbin_client = self.saved
+        shutil.rmtree(self.db_dir)
+
+    def test_from_store(self):
+        now = int(time.time())
+        price.store().add_points(1, pricestore.DAILY, [(now - 2 * 86400, 900), (now - 86400, 1000)])
+        price.store().add_points(1, pricestore.MARKET, [(now - 60, 1100)])
+        track = backtest.PriceTrack.from_store(1, days=7)
+        self.assertEqual(track.values.tolist(), [900, 1000, 1100])
+
+
+if __name__ == '__main__':
+    unittest.main()
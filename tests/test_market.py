@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest import mock
+
+from futme import market, price
+from futme.transfer import TransferMarket
+
+
+class EmptyMarketSession(object):
+    '''A FUT session whose searches never find anything'''
+
+    def __init__(self):
+        self.searches = 0
+
+    def search(self, ctype, **kwargs):
+        self.searches += 1
+        return []
+
+
+class StubFutme(object):
+
+    def __init__(self, session):
+        self._session = session
+
+    def session(self):
+        return self._session
+
+
+class BuyNowTest(unittest.TestCase):
+    '''Traders share searches, but each one still polls at its own interval'''
+
+    def setUp(self):
+        self.now = 1500000000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.saved = market.observations
+        market.observations = market.MarketObservations()
+        self.session = EmptyMarketSession()
+        self.tm = TransferMarket(StubFutme(self.session))
+
+    def tearDown(self):
+        market.observations = self.saved
+
+    def test_own_searches_do_not_skip(self):
+        trader = object()
+        # a trader with interval=5: well inside market.FRESH_FOR of its last empty search
+        for i in range(6):
+            self.assertIsNone(self.tm.buy_now(1, 1000, observer=trader))
+            self.now += 5
+        self.assertEqual(self.session.searches, 6)
+
+    def test_other_traders_searches_skip(self):
+        self.tm.buy_now(1, 1000, observer=object())
+        self.now += 5
+        self.tm.buy_now(1, 1000, observer=object())
+        self.assertEqual(self.session.searches, 1)
+        # unless the search is no longer fresh
+        self.now += market.FRESH_FOR
+        self.tm.buy_now(1, 1000, observer=object())
+        self.assertEqual(self.session.searches, 2)
+
+
+class QuickPrices(object):
+    '''futbin quick prices, counting the requests'''
+
+    def __init__(self, prices):
+        self.prices = prices
+        self.requests = 0
+
+    def get_json(self, url):
+        self.requests += 1
+        rid = url.split('=')[-1]
+        return {rid: {'prices': {'ps': {'LCPrice': self.prices[int(rid)]}}}}
+
+
+class SeedPriceTest(unittest.TestCase):
+    '''Min price searches start from what is known without a request'''
+
+    def setUp(self):
+        self.saved = price.futbin_client
+        self.futbin = price.futbin_client = QuickPrices({91001: 2000})
+        self.tm = TransferMarket(StubFutme(EmptyMarketSession()))
+
+    def tearDown(self):
+        price.futbin_client = self.saved
+
+    def test_seed(self):
+        # nothing known: the middle of the market range, without asking futbin
+        self.assertEqual(self.tm._seed_price(91001, 1000, 5000), price.LADDER.midpoint(1000, 5000))
+        self.assertEqual(self.futbin.requests, 0)
+        # a cached quick price
+        price.quick(91001)
+        self.assertEqual(self.tm._seed_price(91001, 1000, 5000), 2000)
+        self.assertEqual(self.futbin.requests, 1)
+        # the last lookup beats it
+        self.tm.last_min_prices[91001] = 1800
+        self.assertEqual(self.tm._seed_price(91001, 1000, 5000), 1800)
+        # unless it is out of the market range
+        self.assertEqual(self.tm._seed_price(91001, 1900, 5000), 2000)
+        self.assertEqual(self.futbin.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()